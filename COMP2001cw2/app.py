@@ -1,12 +1,37 @@
+import collections
 import datetime
 import email
+import gzip
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
 from decimal import Decimal
 from flasgger import Swagger
 import bcrypt
 import pyodbc
 import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, make_response, request, stream_with_context
 from functools import wraps
+from coalescing import SingleFlight
+from columnar import CatalogueSnapshot
+from rate_limiting import TokenBucketLimiter
+from trail_engines import RouteGraph, TrailFacetIndex, TrailSearchIndex, encode_delta, encode_polyline
+from write_behind import LocationWriteBuffer, location_payload
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # gzip only
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None # ?format=msgpack answers 406
 
 app = Flask(__name__)
 app.config['SWAGGER'] = {
@@ -20,6 +45,38 @@ app.config['SWAGGER'] = {
     },
     'security': [{'basicAuth': []}]
 }
+# write-behind mode for location updates from live-tracking devices (off by default)
+app.config['LOCATION_WRITE_BEHIND'] = os.environ.get('LOCATION_WRITE_BEHIND', '0') == '1'
+app.config['LOCATION_FLUSH_SIZE'] = int(os.environ.get('LOCATION_FLUSH_SIZE', '200')) # flush when this many writes are queued
+app.config['LOCATION_FLUSH_INTERVAL'] = float(os.environ.get('LOCATION_FLUSH_INTERVAL', '1.0')) # seconds between flushes
+app.config['LOCATION_JOURNAL'] = os.environ.get('LOCATION_JOURNAL', 'location_journal.log')
+# token bucket limits as (tokens per second, burst), per user per route and per user across all routes
+app.config['RATE_LIMITS'] = {
+    'default': (10, 20),
+    'get_trails': (1, 5), # large result set
+    'get_my_trails': (1, 5),
+    'plan_route': (1, 5),
+    'create_trail_location': (20, 40),
+    'update_trail_location': (20, 40),
+}
+app.config['USER_RATE_LIMIT'] = (30, 60)
+app.config['MAX_CONCURRENT_EXPENSIVE'] = int(os.environ.get('MAX_CONCURRENT_EXPENSIVE', '8')) # DB-heavy requests at once
+app.config['CONCURRENCY_WAIT'] = 0.5 # seconds to queue for a slot before answering 503
+# request profiling, send "X-Profile: cpu", "alloc" or "cpu,alloc" as an admin, or sample a fraction of traffic
+app.config['PROFILE_HEADER'] = 'X-Profile'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', '0')) # 0.01 profiles 1% of requests
+app.config['PROFILE_INTERVAL'] = 0.005 # seconds between stack samples
+# points on different trails this close together (metres) are treated as the same place when planning routes
+app.config['ROUTE_JOIN_RADIUS'] = float(os.environ.get('ROUTE_JOIN_RADIUS', '25'))
+app.config['ROUTE_REBUILD_INTERVAL'] = float(os.environ.get('ROUTE_REBUILD_INTERVAL', '5')) # seconds, location edits wait at most this long
+# compress responses bigger than this many bytes, levels kept low so CPU stays cheaper than the bandwidth saved
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', '1024'))
+app.config['GZIP_LEVEL'] = 5
+app.config['BROTLI_QUALITY'] = 4
+# serve reads from an in-process columnar copy of the catalogue (off by default)
+app.config['CATALOGUE_SNAPSHOT'] = os.environ.get('CATALOGUE_SNAPSHOT', '0') == '1'
+app.config['CATALOGUE_REFRESH_INTERVAL'] = float(os.environ.get('CATALOGUE_REFRESH_INTERVAL', '2.0')) # seconds, picks up anything in the change feed
+app.config['CATALOGUE_FULL_REFRESH_INTERVAL'] = float(os.environ.get('CATALOGUE_FULL_REFRESH_INTERVAL', '300')) # seconds, checksum sweep for edits that bypass it
 Swagger(app)
 
 
@@ -49,10 +106,16 @@ def authenticate_user(email, password):
 def require_auth(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        auth_started = time.perf_counter()
         auth = request.authorization
         if not auth or not auth.username or not auth.password:
             return jsonify({"error": "Authorisation header is missing or incomplete"}), 401
 
+        # limited before the credentials are checked, so a client over its limit never costs a database connection
+        limited = check_rate_limit(rate_limit_key(auth.username), f.__name__)
+        if limited:
+            return limited
+
         # Validate user credentials against the database
         conn = getdbconnection()
         cursor = conn.cursor()
@@ -67,7 +130,10 @@ def require_auth(f):
             return jsonify({"error": "Invalid credentials"}), 401
 
         # Add user details to the request context
-        user_info = {"email": auth.username, "userID": user[0], "admin": bool(user[0])}
+        user_info = {"email": auth.username, "userID": user[0], "admin": bool(user[1])}
+        g.user = user_info
+        if user_info["admin"]:
+            start_requested_profile(auth_started)
         return f(user=user_info, *args, **kwargs)
 
     return decorated_function
@@ -86,6 +152,242 @@ def require_role(role):
     return decorator
 
 
+rate_limiter = TokenBucketLimiter()
+limiter_stats = {"limited": 0, "shed": 0}
+
+
+# the email as SQL Server compares it (case and trailing spaces ignored), so spelling it differently
+# doesn't get a client a fresh bucket
+def rate_limit_key(username):
+    return username.rstrip().lower()
+
+
+def check_rate_limit(client, route):
+    rate, burst = app.config['RATE_LIMITS'].get(route, app.config['RATE_LIMITS']['default'])
+    wait = rate_limiter.take((client, route), rate, burst)
+    if not wait:
+        user_rate, user_burst = app.config['USER_RATE_LIMIT']
+        wait = rate_limiter.take((client, '*'), user_rate, user_burst)
+    if not wait:
+        return None
+    limiter_stats["limited"] += 1
+    response = jsonify({"error": "Too many requests, slow down"})
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response, 429
+
+
+# global cap on DB-heavy requests in flight, extra requests queue briefly then get a 503
+# used as a route decorator, or around a single-flight load so only the leader takes a slot
+expensive_slots = threading.BoundedSemaphore(app.config['MAX_CONCURRENT_EXPENSIVE'])
+
+
+def limit_concurrency(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not expensive_slots.acquire(timeout=app.config['CONCURRENCY_WAIT']):
+            limiter_stats["shed"] += 1
+            response = jsonify({"error": "Service busy, try again shortly"})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        try:
+            return f(*args, **kwargs)
+        finally:
+            expensive_slots.release()
+
+    return wrapper
+
+
+single_flight = SingleFlight()
+
+
+# concurrent identical reads share one query and one encoded response, see SingleFlight.
+# the leader's response is frozen to bytes so every caller gets its own Response object. it carries the flight's
+# (lock, {encoding: compressed body}) so the body is compressed once per encoding, and any flight_meta the load
+# set on it so every caller can run its own checks on the shared result
+def shared_response(key, load):
+    def freeze():
+        response = make_response(load())
+        return (response.get_data(), response.status_code, list(response.headers.items()),
+                getattr(response, 'flight_meta', None), (threading.Lock(), {}))
+
+    body, status, headers, meta, variants = single_flight.do(key, freeze)
+    response = Response(body, status=status, headers=headers)
+    response.encoded_variants = variants
+    response.flight_meta = meta
+    return response
+
+
+# sampling profiler for individual requests
+# a background thread snapshots the stack of every request thread being profiled every few ms,
+# stacks are kept in collapsed form ("outer;inner;leaf count") which flamegraph.pl and speedscope read directly.
+# tracemalloc sees every thread, so an allocation profile only starts when its request is the only one in flight
+class RequestProfiler:
+    def __init__(self, interval, keep=50):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {} # thread ident -> profile being recorded
+        self.profiles = collections.deque(maxlen=keep)
+        self.routes = {} # endpoint -> collapsed stack counts across every kept profile
+        self.in_flight = 0 # requests being handled
+        self.tracing = None # the profile that has tracemalloc running, one at a time
+        self.thread = None
+        self.next_id = 1
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+            if self.tracing is not None:
+                self.tracing["overlapping"] += 1
+
+    def request_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def begin(self, kinds):
+        profile = {
+            "id": None,
+            "route": request.endpoint,
+            "method": request.method,
+            "path": request.path,
+            "started": time.perf_counter(),
+            "stacks": collections.Counter(),
+            "samples": 0,
+            "allocations": None,
+            "authMs": None,
+            "tracing": False,
+            "overlapping": 0, # requests that started while tracemalloc was running for this one
+        }
+        if 'alloc' in kinds:
+            with self.lock:
+                others = self.in_flight - 1
+                if not others and self.tracing is None and not tracemalloc.is_tracing():
+                    self.tracing = profile
+                    profile["tracing"] = True
+                    tracemalloc.start(PROFILE_TRACEBACK_DEPTH)
+            if not profile["tracing"]:
+                profile["allocations"] = [f"skipped: {others} other request(s) in flight and tracemalloc "
+                                          "would count their allocations too"]
+        if 'cpu' in kinds:
+            with self.lock:
+                self.active[threading.get_ident()] = profile
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+                    self.thread.start()
+        return profile
+
+    def end(self, profile, keep):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+        if profile["tracing"]:
+            profile["tracing"] = False
+            try:
+                if keep:
+                    current, peak = tracemalloc.get_traced_memory()
+                    snapshot = tracemalloc.take_snapshot().filter_traces(PROFILE_ALLOC_FILTERS)
+                    profile["allocations"] = [
+                        f"traced memory: current={current} B, peak={peak} B",
+                        f"covers all threads, {profile['overlapping']} other request(s) started during the trace",
+                    ]
+                    profile["allocations"] += [str(stat) for stat in snapshot.statistics('lineno')[:25]]
+            finally:
+                with self.lock:
+                    tracemalloc.stop()
+                    self.tracing = None
+        if not keep:
+            return
+        profile["durationMs"] = round((time.perf_counter() - profile.pop("started")) * 1000, 2)
+        del profile["tracing"]
+        with self.lock:
+            profile["id"] = self.next_id
+            self.next_id += 1
+            self.profiles.append(profile)
+            self.routes.setdefault(profile["route"], collections.Counter()).update(profile["stacks"])
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, profile in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        profile["stacks"][collapse_stack(frame)] += 1
+                        profile["samples"] += 1
+
+    def get(self, profileID):
+        with self.lock:
+            for profile in self.profiles:
+                if profile["id"] == profileID:
+                    return profile
+        return None
+
+    def route_stacks(self, route):
+        with self.lock:
+            return collections.Counter(self.routes.get(route, {}))
+
+    def summary(self):
+        with self.lock:
+            return [{key: profile[key] for key in ("id", "route", "method", "path", "durationMs", "authMs", "samples")}
+                    for profile in self.profiles]
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def collapsed_text(stacks):
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+PROFILE_TRACEBACK_DEPTH = 10
+PROFILE_ALLOC_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__)]
+profiler = RequestProfiler(app.config['PROFILE_INTERVAL'])
+
+
+# count the request in flight and start a CPU profile if it is picked by sampling
+@app.before_request
+def start_profile():
+    profiler.request_started()
+    g.profile_counted = True
+    if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        g.profile = profiler.begin({'cpu'})
+
+
+# profiles asked for with the header, called by require_auth once it has found an admin
+# so nobody else can switch on the sampler or tracemalloc. authMs is the time spent before it started
+def start_requested_profile(auth_started):
+    kinds = {kind.strip().lower() for kind in request.headers.get(app.config['PROFILE_HEADER'], '').split(',')}
+    if kinds & {'cpu', 'alloc'} and 'profile' not in g:
+        g.profile = profiler.begin(kinds)
+        g.profile["authMs"] = round((time.perf_counter() - auth_started) * 1000, 2)
+
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.end(profile, True)
+        response.headers['X-Profile-Id'] = str(profile["id"])
+    return response
+
+
+# make sure a request that raised doesn't leave its thread registered with the sampler
+@app.teardown_request
+def abandon_profile(error=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.end(profile, False)
+    if g.pop('profile_counted', False):
+        profiler.request_finished()
+
+
 # authentication test
 @app.route('/protected', methods=['GET'])
 @require_auth
@@ -119,12 +421,421 @@ def serialise_row(row, description):
     return row_dict
 
 
+# add rows to the ChangeLog table in the caller's transaction, call it just before commit
+# changes are (entity, op, trailID, entityID, payload), deletes are recorded with op "delete" and no payload
+def record_changes(cursor, changes):
+    if not changes:
+        return
+    # writers take turns from here to commit so sequence numbers become visible in order
+    # and a client reading since=N never skips a row that commits late
+    cursor.execute("EXEC sp_getapplock @Resource = 'ChangeLog', @LockMode = 'Exclusive', @LockOwner = 'Transaction'")
+    cursor.executemany(
+        "INSERT INTO ChangeLog (entity, op, trailID, entityID, payload) VALUES (?, ?, ?, ?, ?)",
+        [(entity, op, trailID, entityID, None if payload is None else json.dumps(payload, default=str))
+         for entity, op, trailID, entityID, payload in changes]
+    )
+
+
+# errors that mean the row itself is bad rather than the connection
+# anything else, a missing table included, fails the whole batch and it is re-queued
+ROW_ERRORS = (pyodbc.DataError, pyodbc.IntegrityError)
+
+
+# the read replica and route graph reload flushed trails on their next refresh
+def location_flushed(trailIDs):
+    for trailID in trailIDs:
+        catalogue.mark_dirty(trailID)
+        trail_network.mark_dirty(trailID)
+
+
+location_buffer = LocationWriteBuffer(
+    app.config['LOCATION_JOURNAL'],
+    app.config['LOCATION_FLUSH_SIZE'],
+    app.config['LOCATION_FLUSH_INTERVAL'],
+    getdbconnection,
+    record_changes,
+    ROW_ERRORS,
+    location_flushed
+)
+
+
+# check a location body is well formed before it is queued, so a bad write is refused now rather than at flush
+def validate_location(data):
+    if not data:
+        return "Invalid input"
+    for field in ('longitude', 'latitude', 'trailOrder'):
+        if field not in data:
+            return f"Missing required field: {field}"
+    for field, low, high in (('longitude', -180, 180), ('latitude', -90, 90)):
+        value = data[field]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+            return f"{field} must be a number between {low} and {high}"
+    if isinstance(data['trailOrder'], bool) or not isinstance(data['trailOrder'], int):
+        return "trailOrder must be an integer"
+    return None
+
+
+search_index = TrailSearchIndex()
+facet_index = TrailFacetIndex()
+
+
+# load the search and facet indexes from the database in one go
+def build_indexes():
+    conn = getdbconnection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT TrailID, name, description, isPublic, loop, userID FROM Trail")
+    trails = cursor.fetchall()
+    cursor.execute("SELECT trailID, featureID, feature FROM trailFeatures")
+    features = cursor.fetchall()
+    conn.close()
+
+    search_index.load([(row[0], row[1], row[2], row[3], row[5]) for row in trails], features)
+    facet_index.load([(row[0], row[3], row[4], row[5]) for row in trails], features)
+
+
+def ensure_indexes():
+    if not (search_index.built and facet_index.built):
+        build_indexes()
+
+
+# keeps the in-process read replica up to date
+# every refresh reads the trails changed since the last ChangeLog seq it saw and reloads only those,
+# plus any trails this service marked dirty. writes that bypass the change feed (direct DB edits) are
+# caught on the full refresh interval by comparing per-trail checksums, again reloading only what differs.
+# while one request refreshes the others keep reading the previous snapshot
+class Catalogue:
+    def __init__(self, refresh_interval, full_refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.snapshot = None
+        self.dirty = set()
+        self.lock = threading.Lock() # guards dirty only
+        self.refresh_lock = threading.Lock()
+        self.change_seq = None # last ChangeLog seq applied, None when the table isn't there
+        self.checksums = {} # trailID -> (Trail, Location, trailFeatures) checksums
+        self.last_refresh = 0.0
+        self.last_full_refresh = 0.0
+        self.stats = {"fullRefreshes": 0, "incrementalRefreshes": 0, "checksumSweeps": 0, "lastRefreshMs": 0.0}
+
+    def mark_dirty(self, trailID):
+        with self.lock:
+            self.dirty.add(trailID)
+
+    def current(self):
+        snapshot = self.snapshot
+        if snapshot is not None and time.time() - self.last_refresh < self.refresh_interval:
+            return snapshot
+        # only the very first load is waited for
+        self.refresh(wait=snapshot is None)
+        return self.snapshot
+
+    # returns False without refreshing when wait is False and another thread is already refreshing
+    def refresh(self, wait=True):
+        if not self.refresh_lock.acquire(blocking=wait):
+            return False
+        try:
+            started = time.time()
+            full_due = started - self.last_full_refresh >= self.full_refresh_interval
+            with self.lock:
+                dirty, self.dirty = self.dirty, set()
+            conn = getdbconnection()
+            try:
+                cursor = conn.cursor()
+                # the seq and checksums are read before the rows, so anything committed meanwhile is seen next time
+                change_seq, changed = self._changes_since(cursor, self.change_seq)
+                if self.snapshot is None:
+                    checksums = self._checksums(cursor)
+                    self._load_all(cursor)
+                    self.checksums = checksums
+                    self.last_full_refresh = started
+                else:
+                    dirty |= changed
+                    if full_due:
+                        checksums = self._checksums(cursor)
+                        dirty |= {trailID for trailID in checksums.keys() | self.checksums.keys()
+                                  if checksums.get(trailID) != self.checksums.get(trailID)}
+                        self.checksums = checksums
+                        self.last_full_refresh = started
+                        self.stats["checksumSweeps"] += 1
+                    if dirty:
+                        self._reload(cursor, dirty)
+                self.change_seq = change_seq
+            except Exception:
+                # try these trails again next time
+                with self.lock:
+                    self.dirty |= dirty
+                raise
+            finally:
+                conn.close()
+            self.last_refresh = time.time()
+            self.stats["lastRefreshMs"] = round((self.last_refresh - started) * 1000, 2)
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    # trailIDs with ChangeLog rows after seq, and the newest seq, seq None means start from the newest row
+    def _changes_since(self, cursor, seq):
+        try:
+            if seq is None:
+                cursor.execute("SELECT MAX(seq) FROM ChangeLog")
+                return cursor.fetchone()[0] or 0, set()
+            cursor.execute("SELECT trailID, MAX(seq) FROM ChangeLog WHERE seq > ? GROUP BY trailID", (seq,))
+        except pyodbc.ProgrammingError:
+            # migrations.sql hasn't been run, fall back to our own dirty marks and the checksum sweep
+            return None, set()
+        rows = cursor.fetchall()
+        return max([seq] + [row[1] for row in rows]), {row[0] for row in rows}
+
+    # per-trail checksums of all three tables, or of just the given trails
+    def _checksums(self, cursor, trailIDs=None):
+        checksums = {}
+        queries = ("SELECT TrailID, BINARY_CHECKSUM(*) FROM Trail",
+                   "SELECT trailID, CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM Location",
+                   "SELECT trailID, CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM trailFeatures")
+        params, where = [], ""
+        if trailIDs is not None:
+            params = sorted(trailIDs)
+            where = f" WHERE trailID IN ({', '.join('?' for _ in params)})"
+        for i, query in enumerate(queries):
+            cursor.execute(query + where + (" GROUP BY trailID" if i else ""), params)
+            for trailID, checksum in cursor.fetchall():
+                checksums.setdefault(trailID, [None, None, None])[i] = checksum
+        return {trailID: tuple(values) for trailID, values in checksums.items()}
+
+    def _load(self, cursor, table, trailIDs):
+        query = f"SELECT * FROM {table}"
+        params = []
+        if trailIDs is not None:
+            params = sorted(trailIDs)
+            query += f" WHERE trailID IN ({', '.join('?' for _ in params)})"
+        cursor.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        return columns, [tuple(serialise_row(row, cursor.description).values()) for row in cursor.fetchall()]
+
+    def _load_all(self, cursor):
+        self.snapshot = CatalogueSnapshot(*[self._load(cursor, table, None) for table in CATALOGUE_TABLES])
+        self.stats["fullRefreshes"] += 1
+
+    # strings from the fresh rows are appended to the shared table, which starts over on the next full load
+    def _reload(self, cursor, dirty):
+        # fresh checksums for these trails, so the next sweep doesn't reload them again
+        checksums = self._checksums(cursor, dirty)
+        try:
+            fresh = CatalogueSnapshot(*[self._load(cursor, table, dirty) for table in CATALOGUE_TABLES],
+                                      template=self.snapshot)
+            self.snapshot = self.snapshot.splice(dirty, fresh)
+            self.stats["incrementalRefreshes"] += 1
+        except ValueError:
+            # a column changed shape or type, so the old arrays can't be reused
+            checksums = self._checksums(cursor)
+            self._load_all(cursor)
+            self.checksums = {}
+        for trailID in dirty:
+            self.checksums.pop(trailID, None)
+        self.checksums.update(checksums)
+
+    def metrics(self):
+        result = dict(self.stats)
+        result["enabled"] = app.config['CATALOGUE_SNAPSHOT']
+        result["pendingTrails"] = len(self.dirty)
+        result["changeSeq"] = self.change_seq
+        result["ageSeconds"] = round(time.time() - self.last_refresh, 2) if self.snapshot is not None else None
+        if self.snapshot is not None:
+            result.update(self.snapshot.memory())
+        return result
+
+
+CATALOGUE_TABLES = ("Trail", "Location", "trailFeatures")
+catalogue = Catalogue(app.config['CATALOGUE_REFRESH_INTERVAL'], app.config['CATALOGUE_FULL_REFRESH_INTERVAL'])
+
+
+# keeps the route graph current, only the trails whose locations changed are read from the database again.
+# edits are batched into at most one rebuild per rebuild interval, and while one request rebuilds
+# the others keep planning on the previous graph (writers marking trails dirty never wait on a build)
+class TrailNetwork:
+    def __init__(self, join_radius, rebuild_interval):
+        self.join_radius = join_radius
+        self.rebuild_interval = rebuild_interval
+        self.lock = threading.Lock() # guards dirty only
+        self.build_lock = threading.Lock()
+        self.trail_points = None # trailID -> [(LocationID, latitude, longitude)] in trailOrder
+        self.dirty = set()
+        self.graph = None
+        self.last_build = 0.0
+        self.stats = {"builds": 0, "lastBuildMs": 0.0}
+
+    def mark_dirty(self, trailID):
+        with self.lock:
+            self.dirty.add(trailID)
+
+    def current(self):
+        graph = self.graph
+        if graph is not None and (not self.dirty or time.time() - self.last_build < self.rebuild_interval):
+            return graph
+        # only the very first build is waited for
+        if not self.build_lock.acquire(blocking=graph is None):
+            return graph
+        try:
+            with self.lock:
+                dirty, self.dirty = self.dirty, set()
+            if self.graph is not None and not dirty:
+                # built by another request while this one waited
+                return self.graph
+            try:
+                started = time.time()
+                if self.trail_points is None:
+                    self.trail_points = self._load(None)
+                elif dirty:
+                    fresh = self._load(dirty)
+                    for trailID in dirty:
+                        self.trail_points.pop(trailID, None)
+                    self.trail_points.update(fresh)
+                self.graph = RouteGraph(self.trail_points, self.join_radius)
+            except Exception:
+                with self.lock:
+                    self.dirty |= dirty
+                raise
+            self.last_build = time.time()
+            self.stats["builds"] += 1
+            self.stats["lastBuildMs"] = round((self.last_build - started) * 1000, 2)
+            return self.graph
+        finally:
+            self.build_lock.release()
+
+    # only public trails are loaded, one graph serves every caller so it must not route over private ones
+    def _load(self, trailIDs):
+        query = ("SELECT l.trailID, l.LocationID, l.latitude, l.longitude FROM Location l"
+                 " JOIN Trail t ON t.TrailID = l.trailID WHERE t.isPublic = 1")
+        params = []
+        if trailIDs is not None:
+            params = sorted(trailIDs)
+            query += f" AND l.trailID IN ({', '.join('?' for _ in params)})"
+        conn = getdbconnection()
+        cursor = conn.cursor()
+        cursor.execute(query + " ORDER BY l.trailID, l.trailOrder", params)
+        points = {}
+        for trailID, locationID, latitude, longitude in cursor.fetchall():
+            points.setdefault(trailID, []).append((locationID, float(latitude), float(longitude)))
+        conn.close()
+        return points
+
+
+trail_network = TrailNetwork(app.config['ROUTE_JOIN_RADIUS'], app.config['ROUTE_REBUILD_INTERVAL'])
+
+
+# compact encodings for location lists, picked with ?format= or the Accept header
+# columns: one JSON array per field instead of repeating the keys on every point
+# msgpack: the columns layout as MessagePack (needs the msgpack package)
+# polyline: Google encoded polyline of lat/long at 5 decimal places, plus the IDs
+# delta: binary header then zigzag varint deltas of LocationID, trailOrder, latitude and longitude (6 decimal places)
+LOCATION_FORMATS = ('json', 'columns', 'msgpack', 'polyline', 'delta')
+DELTA_MIMETYPE = 'application/x-trail-delta'
+LOCATION_MIMETYPES = { # json first so */* gets json
+    'application/json': 'json',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    DELTA_MIMETYPE: 'delta',
+}
+
+
+def negotiate_location_format():
+    requested = request.args.get('format')
+    if requested:
+        return requested.lower()
+    best = request.accept_mimetypes.best_match(list(LOCATION_MIMETYPES), default='application/json')
+    return LOCATION_MIMETYPES[best]
+
+
+def location_columns(trailID, locations):
+    locations = sorted(locations, key=lambda location: location['trailOrder'])
+    return {
+        "trailID": trailID,
+        "LocationID": [location['LocationID'] for location in locations],
+        "trailOrder": [location['trailOrder'] for location in locations],
+        "longitude": [location['longitude'] for location in locations],
+        "latitude": [location['latitude'] for location in locations],
+    }
+
+
+# build the response for a trail's locations in whichever format the client asked for
+def location_response(trailID, locations):
+    output = negotiate_location_format()
+    if output not in LOCATION_FORMATS:
+        return jsonify({"error": f"Unknown format, expected one of: {', '.join(LOCATION_FORMATS)}"}), 400
+    if output == 'json':
+        response = jsonify(locations)
+    else:
+        columns = location_columns(trailID, locations)
+        if output == 'columns':
+            response = jsonify(columns)
+        elif output == 'polyline':
+            response = jsonify({
+                "trailID": trailID,
+                "LocationID": columns['LocationID'],
+                "trailOrder": columns['trailOrder'],
+                "polyline": encode_polyline(columns['latitude'], columns['longitude']),
+                "precision": 5
+            })
+        elif output == 'msgpack':
+            if msgpack is None:
+                return jsonify({"error": "MessagePack is not available on this server"}), 406
+            response = Response(msgpack.packb(columns), mimetype='application/msgpack')
+        else:
+            response = Response(encode_delta(columns), mimetype=DELTA_MIMETYPE)
+    response.vary.add('Accept')
+    return response
+
+
+# gzip/brotli for larger responses when the client accepts it
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding = 'br'
+    elif accepted['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    # coalesced requests share the same body, so whichever gets here first compresses it for the rest
+    shared = getattr(response, 'encoded_variants', None)
+    if shared is None:
+        compressed = compress_body(data, encoding)
+    else:
+        lock, variants = shared
+        with lock:
+            if encoding not in variants:
+                variants[encoding] = compress_body(data, encoding)
+            compressed = variants[encoding]
+    if len(compressed) >= len(data):
+        return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=app.config['GZIP_LEVEL'])
+
+
 # get all trails
 @app.route('/api/trails', methods=['GET'])
 @require_auth
+@limit_concurrency
 def get_trails(user):
     """
-    Retrieve all trails.
+    Retrieve trails visible to the caller: public trails and their own, or every trail for admins.
         ---
     tags:
       - Trails
@@ -164,10 +875,81 @@ def get_trails(user):
       500:
         description: Internal server error
     """
+    return list_trails(user, mine=False)
+
+
+# get the caller's own trails
+@app.route('/api/trails/mine', methods=['GET'])
+@require_auth
+@limit_concurrency
+def get_my_trails(user):
+    """
+    Retrieve the trails owned by the caller, public or private.
+    ---
+    tags:
+      - Trails
+    security:
+      - basicAuth: []
+    responses:
+      200:
+        description: A list of the caller's trails
+      401:
+        description: Unauthorised - Invalid credentials
+      404:
+        description: No trails found
+      500:
+        description: Internal server error
+    """
+    return list_trails(user, mine=True)
+
+
+# who can see a trail: everyone when it is public, its owner, and admins. a NULL isPublic counts as private
+def can_view(user, isPublic, ownerID):
+    return bool(user['admin'] or isPublic or ownerID == user['userID'])
+
+
+# the viewer the search and facet indexes filter by, None lets admins see every trail
+def index_viewer(user):
+    return None if user['admin'] else user['userID']
+
+
+# (isPublic, userID) of a trail, or None if it doesn't exist. the cursor is only needed without the snapshot
+def trail_access(trailID, cursor=None):
+    if app.config['CATALOGUE_SNAPSHOT']:
+        trail = catalogue.current().trail(trailID)
+        return None if trail is None else (trail['isPublic'], trail['userID'])
+    cursor.execute("SELECT isPublic, userID FROM Trail WHERE TrailID = ?", (trailID,))
+    row = cursor.fetchone()
+    return None if row is None else (row[0], row[1])
+
+
+# list trails with the visibility rules applied in SQL so the indexes on
+# Trail(isPublic, TrailID) and Trail(userID, TrailID) can be used instead of a full scan
+def list_trails(user, mine):
     try:
+        if app.config['CATALOGUE_SNAPSHOT']:
+            result = [trail for trail in catalogue.current().all_trails()
+                      if trail['userID'] == user['userID']
+                      or (not mine and can_view(user, trail['isPublic'], trail['userID']))]
+            if not result:
+                return jsonify({"message": "No trails found"}), 404
+            return jsonify(result)
+
         conn = getdbconnection()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM Trail")
+        if mine:
+            cursor.execute("SELECT * FROM Trail WHERE userID = ?", (user["userID"],))
+        elif user["admin"]:
+            cursor.execute("SELECT * FROM Trail")
+        else:
+            # two index seeks rather than one OR that would scan, the second half skips
+            # the caller's public trails so nothing comes back twice (NULL counts as private, as in can_view)
+            cursor.execute(
+                "SELECT * FROM Trail WHERE isPublic = 1"
+                " UNION ALL"
+                " SELECT * FROM Trail WHERE userID = ? AND (isPublic = 0 OR isPublic IS NULL)",
+                (user["userID"],)
+            )
         trails = cursor.fetchall()
         conn.close()
 
@@ -183,6 +965,186 @@ def get_trails(user):
         return jsonify({"error": str(e)}), 500
 
 
+# search trails
+@app.route('/api/trails/search', methods=['GET'])
+@require_auth
+def search_trails(user):
+    """
+    Search the trails visible to the caller by name, description and features.
+    ---
+    tags:
+      - Trails
+    security:
+      - basicAuth: []
+    parameters:
+      - name: q
+        in: query
+        required: true
+        type: string
+        description: Search text, the last word is matched as a prefix
+      - name: limit
+        in: query
+        required: false
+        type: integer
+        description: Maximum number of results (default 20)
+    responses:
+      200:
+        description: Matching trails, best match first
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                results:
+                  type: array
+                  items:
+                    type: object
+                    properties:
+                      trailID:
+                        type: integer
+                      name:
+                        type: string
+                      description:
+                        type: string
+                      features:
+                        type: array
+                        items:
+                          type: string
+                      score:
+                        type: number
+                tookMs:
+                  type: number
+      400:
+        description: Bad request - Missing search text
+      401:
+        description: Unauthorised - Invalid credentials
+      500:
+        description: Internal server error
+    """
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({"error": "Search text (q) is required"}), 400
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+
+        ensure_indexes()
+        started = time.perf_counter()
+        results = search_index.search(query, limit, viewer=index_viewer(user))
+        took_ms = (time.perf_counter() - started) * 1000
+
+        return jsonify({"results": results, "tookMs": round(took_ms, 3)})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# read an optional true/false query parameter
+def bool_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+
+# split a comma separated query parameter
+def list_arg(name):
+    return [item.strip() for item in request.args.get(name, '').split(',') if item.strip()]
+
+
+# filter trails by features and flags
+@app.route('/api/trails/facets', methods=['GET'])
+@require_auth
+@limit_concurrency
+def get_trail_facets(user):
+    """
+    Filter the trails visible to the caller by features and flags, with facet counts, in one call.
+    ---
+    tags:
+      - Trails
+    security:
+      - basicAuth: []
+    parameters:
+      - name: all
+        in: query
+        required: false
+        type: string
+        description: Comma separated features the trail must have all of (e.g. waterfall,parking)
+      - name: any
+        in: query
+        required: false
+        type: string
+        description: Comma separated features the trail must have at least one of
+      - name: isPublic
+        in: query
+        required: false
+        type: boolean
+      - name: loop
+        in: query
+        required: false
+        type: boolean
+      - name: limit
+        in: query
+        required: false
+        type: integer
+        description: Maximum number of trails to return (default 50), counts always cover every match
+    responses:
+      200:
+        description: Matching trails and feature counts within the matches
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                count:
+                  type: integer
+                trails:
+                  type: array
+                  items:
+                    type: object
+                facets:
+                  type: object
+                  additionalProperties:
+                    type: integer
+                flags:
+                  type: object
+                  properties:
+                    isPublic:
+                      type: integer
+                    loop:
+                      type: integer
+      401:
+        description: Unauthorised - Invalid credentials
+      500:
+        description: Internal server error
+    """
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+
+        ensure_indexes()
+        trailIDs, facets, flags = facet_index.query(
+            all_features=list_arg('all'),
+            any_features=list_arg('any'),
+            isPublic=bool_arg('isPublic'),
+            loop=bool_arg('loop'),
+            viewer=index_viewer(user)
+        )
+
+        trails = []
+        page = trailIDs[:limit]
+        if page:
+            conn = getdbconnection()
+            cursor = conn.cursor()
+            placeholders = ", ".join("?" for _ in page)
+            cursor.execute(f"SELECT * FROM Trail WHERE TrailID IN ({placeholders}) ORDER BY TrailID", page)
+            trails = [serialise_row(row, cursor.description) for row in cursor.fetchall()]
+            conn.close()
+
+        return jsonify({"count": len(trailIDs), "trails": trails, "facets": facets, "flags": flags})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 # get an individual trail
 @app.route('/api/Trail/<int:trailID>', methods=['GET'])
 @require_auth
@@ -233,7 +1195,22 @@ def get_trail(user, trailID):
           500:
             description: Internal server error
         """
+    response = shared_response(('trail', trailID), lambda: read_trail(trailID))
+    # the shared result is checked per caller, a trail they can't see looks the same as a missing one
+    if response.flight_meta is not None and not can_view(user, *response.flight_meta):
+        return jsonify({"error": "No trail found with the given ID"}), 404
+    return response
+
+
+# load and encode one trail, shared by every concurrent request for it
+def read_trail(trailID):
     try:
+        if app.config['CATALOGUE_SNAPSHOT']:
+            result = catalogue.current().trail(trailID)
+            if not result:
+                return jsonify({"error": "No trail found with the given ID"}), 404
+            return trail_response(result)
+
         conn = getdbconnection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM Trail WHERE TrailID = ?", (trailID,))
@@ -246,12 +1223,18 @@ def get_trail(user, trailID):
         # Directly serialise the single row
         result = serialise_row(trail, cursor.description)
 
-        return jsonify(result)
+        return trail_response(result)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+def trail_response(trail):
+    response = jsonify(trail)
+    response.flight_meta = (trail['isPublic'], trail['userID'])
+    return response
+
+
 # create a new trail
 @app.route('/api/trails', methods=['POST'])
 @require_auth
@@ -315,6 +1298,7 @@ def create_trail(user):
         cursor.execute(
             """
             INSERT INTO Trail (name, description, elevationGain, estTime, loop, isPublic, userID)
+            OUTPUT INSERTED.TrailID
             VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
             (
@@ -327,9 +1311,22 @@ def create_trail(user):
                 user["userID"]
             )
         )
+        trailID = cursor.fetchone()[0]
+        record_changes(cursor, [("Trail", "upsert", trailID, trailID, {
+            "name": data["name"],
+            "description": data["description"],
+            "elevationGain": data.get("elevationGain", 0),
+            "estTime": data.get("estTime", "00:00"),
+            "loop": data.get("loop", False),
+            "isPublic": data.get("isPublic", True),
+            "userID": user["userID"]
+        })])
         conn.commit()
         conn.close()
-        return jsonify({"message": "Trail created successfully"}), 201
+        search_index.add_trail(trailID, data["name"], data["description"], data.get("isPublic", True), user["userID"])
+        facet_index.set_trail(trailID, data.get("isPublic", True), data.get("loop", False), user["userID"])
+        catalogue.mark_dirty(trailID)
+        return jsonify({"message": "Trail created successfully", "trailID": trailID}), 201
 
     except KeyError as e:
         return jsonify({"error": f"Missing required field: {str(e)}"}), 400
@@ -403,6 +1400,7 @@ def update_trail(user, trailID):
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE Trail SET name = ?, description = ?, elevationGain = ?, estTime = ?, loop = ?, isPublic = ? "
+            "OUTPUT DELETED.isPublic "
             "WHERE TrailID = ?",
             (
                 data["name"],
@@ -414,13 +1412,41 @@ def update_trail(user, trailID):
                 trailID,
             ),
         )
+        previous = cursor.fetchone()
+        updated = previous is not None
+        if updated:
+            changes = [("Trail", "upsert", trailID, trailID, {
+                field: data[field] for field in ("name", "description", "elevationGain", "estTime", "loop", "isPublic")
+            })]
+            if data["isPublic"] and not previous[0]:
+                changes += trail_content_changes(cursor, trailID)
+            record_changes(cursor, changes)
         conn.commit()
         conn.close()
+        if updated:
+            search_index.update_trail(trailID, data["name"], data["description"], data["isPublic"])
+            facet_index.set_trail(trailID, data["isPublic"], data["loop"])
+            catalogue.mark_dirty(trailID)
+            # only public trails are routed over
+            trail_network.mark_dirty(trailID)
         return jsonify({"message": "Trail updated successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+# upserts for every location and feature a trail has now, recorded when it becomes public.
+# the change feed skips them for other users while the trail is private, so without these a client
+# that synced past them would only ever get the trail itself
+def trail_content_changes(cursor, trailID):
+    cursor.execute("SELECT LocationID, longitude, latitude, trailOrder FROM Location WHERE trailID = ?", (trailID,))
+    locations = [serialise_row(row, cursor.description) for row in cursor.fetchall()]
+    cursor.execute("SELECT featureID, feature FROM trailFeatures WHERE trailID = ?", (trailID,))
+    features = cursor.fetchall()
+    return ([("Location", "upsert", trailID, location["LocationID"], location_payload(location))
+             for location in locations] +
+            [("Feature", "upsert", trailID, featureID, {"feature": feature}) for featureID, feature in features])
+
+
 # delete a trail
 @app.route('/api/Trail/<int:trailID>', methods=['DELETE'])
 @require_auth
@@ -451,12 +1477,20 @@ def delete_trail(user, trailID):
             description: Internal server error
         """
     try:
+        location_buffer.discard(trailID)
         conn = getdbconnection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM Location WHERE trailID = ?", (trailID,))
         cursor.execute("DELETE FROM Trail WHERE TrailID = ?", (trailID,))
+        if cursor.rowcount:
+            # one tombstone for the trail covers its locations and features too
+            record_changes(cursor, [("Trail", "delete", trailID, trailID, None)])
         conn.commit()
         conn.close()
+        search_index.remove_trail(trailID)
+        facet_index.remove_trail(trailID)
+        catalogue.mark_dirty(trailID)
+        trail_network.mark_dirty(trailID)
         return jsonify({"message": "Trail deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -465,6 +1499,7 @@ def delete_trail(user, trailID):
 # create location for trail
 @app.route('/api/Trail/<int:trailID>/locations', methods=['POST'])
 @require_auth
+@limit_concurrency
 def create_trail_location(user, trailID):
     """
     Create a new location for a trail.
@@ -503,6 +1538,8 @@ def create_trail_location(user, trailID):
     responses:
         201:
             description: Location created successfully
+        202:
+            description: Location accepted and queued (write-behind mode)
         400:
             description: Bad request - Invalid input
         401:
@@ -512,14 +1549,26 @@ def create_trail_location(user, trailID):
     """
     try:
         data = request.get_json()
+        if app.config['LOCATION_WRITE_BEHIND'] and location_buffer.start():
+            error = validate_location(data)
+            if error:
+                return jsonify({"error": error}), 400
+            location_buffer.enqueue_create(trailID, data['longitude'], data['latitude'], data['trailOrder'])
+            return jsonify({"message": "Location accepted"}), 202
+
         conn = getdbconnection()
         cursor = conn.cursor()
         cursor.execute("INSERT INTO Location (trailID, longitude, latitude, trailOrder)"
+                       " OUTPUT INSERTED.LocationID"
                        " VALUES (?, ?, ?, ?)",
                        (trailID, data['longitude'], data['latitude'], data['trailOrder'],))
+        locationID = cursor.fetchone()[0]
+        record_changes(cursor, [("Location", "upsert", trailID, locationID, location_payload(data))])
         conn.commit()
         conn.close()
-        return jsonify({"message": "Location created successfully"}), 201
+        catalogue.mark_dirty(trailID)
+        trail_network.mark_dirty(trailID)
+        return jsonify({"message": "Location created successfully", "locationID": locationID}), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -542,27 +1591,55 @@ def get_trail_locations(user, trailID):
             description: ID of the trail for which locations are being retrieved.
             schema:
               type: integer
+          - name: format
+            in: query
+            required: false
+            type: string
+            enum: [json, columns, msgpack, polyline, delta]
+            description: Response layout, defaults to json (can also be chosen with the Accept header)
         responses:
           200:
             description: List of locations for the specified trail.
+          400:
+            description: Unknown format.
           401:
             description: Unauthorized - Invalid credentials.
           404:
             description: No locations found for the given trail.
+          406:
+            description: MessagePack requested but not available.
           500:
             description: Internal server error.
     """
-    try:
-        conn = getdbconnection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM Location WHERE trailID = ?", (trailID,))
-        locations = cursor.fetchall()
-        conn.close()
+    # the concurrency slot is taken inside the flight, waiters only hold a request thread
+    response = shared_response(('locations', trailID, negotiate_location_format()),
+                               limit_concurrency(lambda: read_trail_locations(trailID)))
+    if response.flight_meta is not None and not can_view(user, *response.flight_meta):
+        return jsonify({"message": "No locations found for the given trail"}), 404
+    return response
+
 
-        if not locations:
+# load and encode a trail's locations, shared by every concurrent request for the same trail and format
+def read_trail_locations(trailID):
+    try:
+        if app.config['CATALOGUE_SNAPSHOT']:
+            access = trail_access(trailID)
+            result = catalogue.current().trail_locations(trailID)
+        else:
+            conn = getdbconnection()
+            cursor = conn.cursor()
+            access = trail_access(trailID, cursor)
+            cursor.execute("SELECT * FROM Location WHERE trailID = ?", (trailID,))
+            result = [serialise_row(row, cursor.description) for row in cursor.fetchall()]
+            conn.close()
+
+        if not result or access is None:
             return jsonify({"message": "No locations found for the given trail"}), 404
 
-        return jsonify([serialise_row(row, cursor.description) for row in locations])
+        # checked per caller by get_trail_locations
+        response = make_response(location_response(trailID, result))
+        response.flight_meta = access
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -570,6 +1647,7 @@ def get_trail_locations(user, trailID):
 # update a location
 @app.route('/api/Trail/<int:trailID>/locations/<int:locationID>', methods=['PUT'])
 @require_auth
+@limit_concurrency
 def update_trail_location(user, trailID, locationID):
     """
     Update a location within a trail.
@@ -622,6 +1700,8 @@ def update_trail_location(user, trailID, locationID):
                 properties:
                   message:
                     type: string
+        202:
+          description: Location update accepted and queued (write-behind mode)
         400:
           description: Bad request - Invalid input
         401:
@@ -631,13 +1711,24 @@ def update_trail_location(user, trailID, locationID):
     """
     try:
         data = request.get_json()
+        if app.config['LOCATION_WRITE_BEHIND'] and location_buffer.start():
+            error = validate_location(data)
+            if error:
+                return jsonify({"error": error}), 400
+            location_buffer.enqueue_update(trailID, locationID, data['longitude'], data['latitude'], data['trailOrder'])
+            return jsonify({"message": "Location update accepted"}), 202
+
         conn = getdbconnection()
         cursor = conn.cursor()
         cursor.execute("UPDATE Location SET longitude = ?, latitude = ?, trailOrder = ?"
                        " WHERE trailID = ? AND LocationID = ?",
                        (data['longitude'], data['latitude'], data['trailOrder'], trailID, locationID))
+        if cursor.rowcount:
+            record_changes(cursor, [("Location", "upsert", trailID, locationID, location_payload(data))])
         conn.commit()
         conn.close()
+        catalogue.mark_dirty(trailID)
+        trail_network.mark_dirty(trailID)
         return jsonify({"message": "Location updated successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -677,20 +1768,532 @@ def delete_trail_location(user, trailID, locationID):
             description: Internal server error
     """
     try:
+        location_buffer.discard(trailID, locationID)
         conn = getdbconnection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM Location WHERE trailID = ? AND LocationID = ?", (trailID, locationID))
+        if cursor.rowcount:
+            record_changes(cursor, [("Location", "delete", trailID, locationID, None)])
         conn.commit()
         conn.close()
+        catalogue.mark_dirty(trailID)
+        trail_network.mark_dirty(trailID)
         return jsonify({"message": "Location deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+# plan a route across trails
+@app.route('/api/routes/plan', methods=['GET'])
+@require_auth
+@limit_concurrency
+def plan_route(user):
+    """
+    Plan a route over the public trail network, either between two points or as a loop of a given length.
+    ---
+    tags:
+        - Routes
+    security:
+        - basicAuth: []
+    parameters:
+        - name: fromLocation
+          in: query
+          required: false
+          type: integer
+          description: LocationID to start from (or give fromLat and fromLon)
+        - name: fromLat
+          in: query
+          required: false
+          type: number
+        - name: fromLon
+          in: query
+          required: false
+          type: number
+        - name: toLocation
+          in: query
+          required: false
+          type: integer
+          description: LocationID to finish at (or give toLat and toLon), leave out to plan a loop
+        - name: toLat
+          in: query
+          required: false
+          type: number
+        - name: toLon
+          in: query
+          required: false
+          type: number
+        - name: distanceKm
+          in: query
+          required: false
+          type: number
+          description: Length of the loop to plan when no destination is given
+    responses:
+        200:
+            description: The planned route
+            content:
+                application/json:
+                    schema:
+                        type: object
+                        properties:
+                            distanceKm:
+                                type: number
+                            trails:
+                                type: array
+                                description: Trail IDs in the order they are walked
+                                items:
+                                    type: integer
+                            path:
+                                type: array
+                                items:
+                                    type: object
+                                    properties:
+                                        latitude:
+                                            type: number
+                                        longitude:
+                                            type: number
+                            tookMs:
+                                type: number
+        400:
+            description: Bad request - Missing start, or neither a destination nor a loop length
+        401:
+            description: Unauthorised - Invalid credentials
+        404:
+            description: No route found, or fromLocation or toLocation isn't on a public trail
+        500:
+            description: Internal server error
+    """
+    try:
+        started = time.perf_counter()
+        graph = trail_network.current()
+        if not len(graph.node_lat):
+            return jsonify({"error": "No trail locations to plan with"}), 404
+
+        # a location on a private trail isn't in the graph either, and looks the same as one that doesn't exist
+        for prefix in ('from', 'to'):
+            locationID = request.args.get(f'{prefix}Location', type=int)
+            if locationID is not None and locationID not in graph.location_nodes:
+                return jsonify({"error": "Unknown location"}), 404
+
+        source = route_point(graph, 'from')
+        if source is None:
+            return jsonify({"error": "Give fromLocation, or fromLat and fromLon"}), 400
+        target = route_point(graph, 'to')
+        distance_km = request.args.get('distanceKm', type=float)
+
+        if target is not None:
+            route = graph.shortest_path(source, target) if source != target else ([source], [])
+        elif distance_km and distance_km > 0:
+            route = graph.loop(source, distance_km * 1000)
+        else:
+            return jsonify({"error": "Give a destination (toLocation, or toLat and toLon) or distanceKm for a loop"}), 400
+
+        if route is None:
+            return jsonify({"error": "No route found"}), 404
+
+        result = graph.describe(*route)
+        result["tookMs"] = round((time.perf_counter() - started) * 1000, 3)
+        return jsonify(result)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# find the graph node for fromLocation/fromLat/fromLon (or the to equivalents)
+def route_point(graph, prefix):
+    locationID = request.args.get(f'{prefix}Location', type=int)
+    if locationID is not None:
+        return graph.location_nodes.get(locationID)
+    latitude = request.args.get(f'{prefix}Lat', type=float)
+    longitude = request.args.get(f'{prefix}Lon', type=float)
+    if latitude is None or longitude is None:
+        return None
+    return graph.nearest_node(latitude, longitude)
+
+
+# change feed for offline clients
+@app.route('/api/changes', methods=['GET'])
+@require_auth
+def get_changes(user):
+    """
+    Retrieve changes made after a sequence number, oldest first.
+    Only trails the caller can see are included, a trail that is no longer visible is sent as a delete.
+    ---
+    tags:
+        - Sync
+    security:
+        - basicAuth: []
+    parameters:
+        - name: since
+          in: query
+          required: false
+          type: integer
+          description: Last sequence number the client has applied (0 for a full sync)
+        - name: limit
+          in: query
+          required: false
+          type: integer
+          description: Maximum number of changes in this page (default 500, max 5000)
+    responses:
+        200:
+            description: A page of changes, pass nextSince back as since while hasMore is true
+            content:
+                application/json:
+                    schema:
+                        type: object
+                        properties:
+                            changes:
+                                type: array
+                                items:
+                                    type: object
+                                    properties:
+                                        seq:
+                                            type: integer
+                                        entity:
+                                            type: string
+                                            enum: [Trail, Location, Feature]
+                                        op:
+                                            type: string
+                                            enum: [upsert, delete]
+                                        trailID:
+                                            type: integer
+                                        entityID:
+                                            type: integer
+                                        data:
+                                            type: object
+                                        changedAt:
+                                            type: string
+                            nextSince:
+                                type: integer
+                            hasMore:
+                                type: boolean
+        400:
+            description: Bad request - Invalid since or limit
+        401:
+            description: Unauthorised - Invalid credentials
+        500:
+            description: Internal server error
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', 500, type=int)
+    if since < 0 or limit < 1:
+        return jsonify({"error": "since must be 0 or more and limit at least 1"}), 400
+    limit = min(limit, 5000)
+
+    try:
+        conn = getdbconnection()
+        cursor = conn.cursor()
+        # visibility is judged on the trail as it is now, with the same rule as can_view
+        cursor.execute(
+            "SELECT TOP (?) c.seq, c.entity, c.op, c.trailID, c.entityID, c.payload, c.changedAt,"
+            " CASE WHEN ? = 1 OR t.isPublic = 1 OR t.userID = ? THEN 1 ELSE 0 END AS visible"
+            " FROM ChangeLog c LEFT JOIN Trail t ON t.TrailID = c.trailID"
+            " WHERE c.seq > ? ORDER BY c.seq",
+            (limit + 1, 1 if user['admin'] else 0, user['userID'], since)
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    # stream the page as it is read rather than building it all in memory
+    def generate():
+        last_seq = since
+        read = 0
+        sent = 0
+        try:
+            yield '{"changes": ['
+            while read < limit:
+                rows = cursor.fetchmany(min(500, limit - read))
+                if not rows:
+                    break
+                for row in rows:
+                    change = serialise_row(row, cursor.description)
+                    payload = change.pop("payload")
+                    visible = change.pop("visible")
+                    last_seq = change["seq"]
+                    read += 1
+                    if not visible:
+                        # a hidden trail is sent as a bare delete so clients drop any copy they had while
+                        # it was public, its locations and features are skipped (update_trail records them
+                        # all again if it becomes public)
+                        if change["entity"] != "Trail":
+                            continue
+                        change["op"], payload = "delete", None
+                    change["data"] = json.loads(payload) if payload else None
+                    yield (',' if sent else '') + json.dumps(change)
+                    sent += 1
+            has_more = read == limit and cursor.fetchone() is not None
+            yield '], "nextSince": %d, "hasMore": %s}' % (last_seq, 'true' if has_more else 'false')
+        finally:
+            conn.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+# list recorded profiles
+@app.route('/api/profiles', methods=['GET'])
+@require_auth
+@require_role('admin')
+def get_profiles(user):
+    """
+    List the most recent request profiles.
+    ---
+    tags:
+        - Admin
+    security:
+        - basicAuth: []
+    responses:
+        200:
+            description: Profile IDs with route, duration and sample count
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+    """
+    return jsonify(profiler.summary())
+
+
+# download one profile
+@app.route('/api/profiles/<int:profileID>', methods=['GET'])
+@require_auth
+@require_role('admin')
+def get_profile(user, profileID):
+    """
+    Download a request profile.
+    ---
+    tags:
+        - Admin
+    security:
+        - basicAuth: []
+    parameters:
+        - name: profileID
+          in: path
+          required: true
+          type: integer
+          description: ID from the X-Profile-Id response header or GET /api/profiles
+        - name: kind
+          in: query
+          required: false
+          type: string
+          enum: [cpu, alloc]
+          description: cpu gives collapsed stacks for a flamegraph (default), alloc gives the top allocation sites
+    responses:
+        200:
+            description: Collapsed stacks or allocation statistics as plain text
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+        404:
+            description: No profile with this ID (only the most recent are kept) or no allocation data recorded
+    """
+    profile = profiler.get(profileID)
+    if profile is None:
+        return jsonify({"error": "No profile found with the given ID"}), 404
+    if request.args.get('kind', 'cpu') == 'alloc':
+        if profile["allocations"] is None:
+            return jsonify({"error": "No allocation data was recorded for this profile"}), 404
+        return Response('\n'.join(profile["allocations"]) + '\n', mimetype='text/plain')
+    return Response(collapsed_text(profile["stacks"]), mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename=profile-{profileID}.collapsed'})
+
+
+# download every kept profile for a route merged together
+@app.route('/api/profiles/routes/<route>', methods=['GET'])
+@require_auth
+@require_role('admin')
+def get_route_profile(user, route):
+    """
+    Download the collapsed stacks of every kept profile for one route, merged.
+    ---
+    tags:
+        - Admin
+    security:
+        - basicAuth: []
+    parameters:
+        - name: route
+          in: path
+          required: true
+          type: string
+          description: Handler name, e.g. get_trails
+    responses:
+        200:
+            description: Collapsed stacks as plain text
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+        404:
+            description: Nothing profiled for this route yet
+    """
+    stacks = profiler.route_stacks(route)
+    if not stacks:
+        return jsonify({"error": "No profiles recorded for this route"}), 404
+    return Response(collapsed_text(stacks), mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename={route}.collapsed'})
+
+
+# single-flight counters
+@app.route('/api/coalescing', methods=['GET'])
+@require_auth
+@require_role('admin')
+def get_coalescing(user):
+    """
+    Retrieve how many identical concurrent reads shared one query.
+    ---
+    tags:
+        - Admin
+    security:
+        - basicAuth: []
+    responses:
+        200:
+            description: Queries executed, requests that waited on another's query, and keys in flight
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+    """
+    return jsonify(single_flight.metrics())
+
+
+# rate limiter counters
+@app.route('/api/limits', methods=['GET'])
+@require_auth
+@require_role('admin')
+def get_limits(user):
+    """
+    Retrieve rate limit settings and how many requests have been limited or shed.
+    ---
+    tags:
+        - Admin
+    security:
+        - basicAuth: []
+    responses:
+        200:
+            description: Limits per route, per user and for concurrent expensive requests
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+        429:
+            description: Too many requests
+    """
+    return jsonify({
+        "routes": {route: {"rate": rate, "burst": burst} for route, (rate, burst) in app.config['RATE_LIMITS'].items()},
+        "user": {"rate": app.config['USER_RATE_LIMIT'][0], "burst": app.config['USER_RATE_LIMIT'][1]},
+        "maxConcurrentExpensive": app.config['MAX_CONCURRENT_EXPENSIVE'],
+        "limited": limiter_stats["limited"],
+        "shed": limiter_stats["shed"],
+    })
+
+
+# write-behind buffer metrics
+@app.route('/api/locations/buffer', methods=['GET'])
+@require_auth
+@require_role('admin')
+def get_location_buffer(user):
+    """
+    Retrieve write-behind queue and flush latency metrics for location writes.
+    ---
+    tags:
+        - Locations
+    security:
+        - basicAuth: []
+    responses:
+        200:
+            description: Queue depth, coalesced writes and flush timings
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+    """
+    metrics = location_buffer.metrics()
+    metrics["enabled"] = app.config['LOCATION_WRITE_BEHIND']
+    return jsonify(metrics)
+
+
+# force the write-behind buffer to flush now
+@app.route('/api/locations/buffer/flush', methods=['POST'])
+@require_auth
+@require_role('admin')
+def flush_location_buffer(user):
+    """
+    Flush queued location writes to the database immediately.
+    ---
+    tags:
+        - Locations
+    security:
+        - basicAuth: []
+    responses:
+        200:
+            description: Number of rows written
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+        500:
+            description: Internal server error
+    """
+    try:
+        return jsonify({"flushed": location_buffer.flush()}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# catalogue snapshot memory and refresh stats
+@app.route('/api/catalogue', methods=['GET'])
+@require_auth
+@require_role('admin')
+def get_catalogue_stats(user):
+    """
+    Retrieve memory use and refresh stats for the in-process catalogue snapshot.
+    ---
+    tags:
+        - Trails
+    security:
+        - basicAuth: []
+    responses:
+        200:
+            description: Bytes held per table, row counts and refresh timings
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+    """
+    return jsonify(catalogue.metrics())
+
+
+# reload the catalogue snapshot now
+@app.route('/api/catalogue/refresh', methods=['POST'])
+@require_auth
+@require_role('admin')
+def refresh_catalogue(user):
+    """
+    Refresh the in-process catalogue snapshot immediately.
+    ---
+    tags:
+        - Trails
+    security:
+        - basicAuth: []
+    responses:
+        200:
+            description: Snapshot refreshed
+        401:
+            description: Unauthorised - Invalid credentials
+        403:
+            description: Forbidden - Admin role required
+        500:
+            description: Internal server error
+    """
+    try:
+        catalogue.refresh()
+        return jsonify(catalogue.metrics()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 # create a feature
 @app.route('/api/Trail/<int:trailID>/features', methods=['POST'])
 @require_auth
-def create_trail_feature(trailID):
+def create_trail_feature(user, trailID):
     """
     Create a new feature for a trail.
     ---
@@ -735,8 +2338,12 @@ def create_trail_feature(trailID):
                        (data['featureID'],
                         trailID,
                         data['feature']))
+        record_changes(cursor, [("Feature", "upsert", trailID, data['featureID'], {"feature": data['feature']})])
         conn.commit()
         conn.close()
+        search_index.set_feature(trailID, data['featureID'], data['feature'])
+        facet_index.set_feature(trailID, data['featureID'], data['feature'])
+        catalogue.mark_dirty(trailID)
         return jsonify({"message": "Feature created successfully"}), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -745,7 +2352,7 @@ def create_trail_feature(trailID):
 # retrieve features
 @app.route('/api/Trail/<int:trailID>/features', methods=['GET'])
 @require_auth
-def get_trail_features(trailID):
+def get_trail_features(user, trailID):
     """
         Retrieve all features for a specific trail.
         ---
@@ -784,16 +2391,21 @@ def get_trail_features(trailID):
             description: Internal server error
         """
     try:
-        conn = getdbconnection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM trailFeatures WHERE trailID = ?", (trailID,))
-        features = cursor.fetchall()
-        conn.close()
-
-        if not features:
+        if app.config['CATALOGUE_SNAPSHOT']:
+            access = trail_access(trailID)
+            result = catalogue.current().trail_features(trailID)
+        else:
+            conn = getdbconnection()
+            cursor = conn.cursor()
+            access = trail_access(trailID, cursor)
+            cursor.execute("SELECT * FROM trailFeatures WHERE trailID = ?", (trailID,))
+            result = [serialise_row(row, cursor.description) for row in cursor.fetchall()]
+            conn.close()
+
+        if not result or access is None or not can_view(user, *access):
             return jsonify({"message": "No features found for the given trail"}), 404
 
-        return jsonify([serialise_row(row, cursor.description) for row in features])
+        return jsonify(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -855,8 +2467,16 @@ def update_trail_feature(user, trailID, featureID):
         cursor = conn.cursor()
         cursor.execute("UPDATE trailFeatures SET feature = ? WHERE trailID = ? AND featureID = ?",
                        (data['feature'], trailID, featureID))
+        updated = cursor.rowcount
+        if updated:
+            record_changes(cursor, [("Feature", "upsert", trailID, featureID, {"feature": data['feature']})])
         conn.commit()
         conn.close()
+        # an unknown featureID must not be added to the in-memory indexes
+        if updated:
+            search_index.set_feature(trailID, featureID, data['feature'])
+            facet_index.set_feature(trailID, featureID, data['feature'])
+            catalogue.mark_dirty(trailID)
         return jsonify({"message": "Feature updated successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -899,12 +2519,28 @@ def delete_trail_feature(user, trailID, featureID):
         conn = getdbconnection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM trailFeatures WHERE trailID = ? AND featureID = ?", (trailID, featureID))
+        deleted = cursor.rowcount
+        if deleted:
+            record_changes(cursor, [("Feature", "delete", trailID, featureID, None)])
         conn.commit()
         conn.close()
+        if deleted:
+            search_index.remove_feature(trailID, featureID)
+            facet_index.remove_feature(trailID, featureID)
+            catalogue.mark_dirty(trailID)
         return jsonify({"message": "Feature deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # build the search index up front so the first search doesn't pay for it
+    try:
+        build_indexes()
+    except Exception as e:
+        print(f"Index build failed, will retry on first request: {e}")
+    # the reloader's child is the process that serves requests, the parent only watches files,
+    # so only the child picks up the write-behind journal (other servers start it on the first write)
+    if app.config['LOCATION_WRITE_BEHIND'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        location_buffer.start()
+    app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,44 @@
+# request coalescing, kept free of Flask so it can be tested on its own
+import threading
+
+
+# single-flight: concurrent calls with the same key share one run of the work
+# the first call for a key runs load(), the rest wait for it and get the same result (or the same exception).
+# the key is forgotten as soon as the load finishes, so later calls run it again, nothing is cached
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key -> [done event, result, error]
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    def do(self, key, load):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+                self.stats["executed"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if leader:
+            try:
+                call[1] = load()
+            except Exception as e:
+                call[2] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call[0].set()
+        else:
+            call[0].wait()
+
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+
+    def metrics(self):
+        with self.lock:
+            result = dict(self.stats)
+            result["inFlight"] = len(self.calls)
+        return result
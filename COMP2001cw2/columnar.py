@@ -0,0 +1,273 @@
+# columnar in-memory copy of the trail catalogue, read by app.py when CATALOGUE_SNAPSHOT is on
+# kept free of Flask and the database so it can be tested on its own
+import array
+import bisect
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # falls back to the array module
+
+
+# one table held column by column: numbers in typed arrays, text as indexes into a shared string table
+class ColumnarTable:
+    # kinds forces each column's type, so rows loaded later can be joined onto an existing table
+    def __init__(self, columns, rows, strings, kinds=None):
+        self.columns = columns
+        self.length = len(rows)
+        self.strings = strings
+        kinds = kinds or [None] * len(columns)
+        self.data = [self._encode([row[i] for row in rows], kinds[i]) for i in range(len(columns))]
+
+    def _encode(self, values, kind=None):
+        present = [value for value in values if value is not None]
+        nulls = tuple(i for i, value in enumerate(values) if value is None)
+        if kind is None:
+            kind = next((name for name, check in COLUMN_KINDS.items()
+                         if name != 'str' and present and all(check(value) for value in present)), 'str')
+        elif not all(COLUMN_KINDS[kind](value) for value in present):
+            raise ValueError(f"column no longer holds {kind} values")
+        if kind == 'str':
+            # text (and anything odd) is interned once per snapshot, -1 is NULL
+            return 'str', make_column('str', [-1 if value is None else self.strings.intern(str(value)) for value in values]), ()
+        return kind, make_column(kind, [0 if value is None else value for value in values]), nulls
+
+    @property
+    def kinds(self):
+        return [kind for kind, _, _ in self.data]
+
+    # joins (table, start, stop) row ranges of tables with the same columns, copying arrays rather than rows
+    @classmethod
+    def join(cls, template, pieces):
+        table = cls.__new__(cls)
+        table.columns = template.columns
+        table.strings = template.strings
+        table.length = sum(stop - start for _, start, stop in pieces)
+        table.data = []
+        for i, kind in enumerate(template.kinds):
+            parts, nulls, base = [], [], 0
+            for source, start, stop in pieces:
+                _, values, source_nulls = source.data[i]
+                parts.append(values[start:stop])
+                first, last = bisect.bisect_left(source_nulls, start), bisect.bisect_left(source_nulls, stop)
+                nulls += [base + row - start for row in source_nulls[first:last]]
+                base += stop - start
+            table.data.append((kind, join_columns(kind, parts), tuple(nulls)))
+        return table
+
+    def rows(self, start=0, stop=None):
+        stop = self.length if stop is None else stop
+        columns = []
+        for kind, values, nulls in self.data:
+            decoded = values[start:stop].tolist()
+            if kind == 'bool':
+                decoded = [bool(value) for value in decoded]
+            elif kind == 'str':
+                decoded = [self.strings.values[value] if value >= 0 else None for value in decoded]
+            for i in nulls[bisect.bisect_left(nulls, start):bisect.bisect_left(nulls, stop)]:
+                decoded[i - start] = None
+            columns.append(decoded)
+        return [dict(zip(self.columns, values)) for values in zip(*columns)]
+
+    def column(self, name):
+        return self.data[self.columns.index(name)][1]
+
+    def nbytes(self):
+        return sum(column_nbytes(values) + sys.getsizeof(nulls) for _, values, nulls in self.data)
+
+
+class StringTable:
+    def __init__(self):
+        self.values = []
+        self.lookup = {}
+
+    def intern(self, value):
+        index = self.lookup.get(value)
+        if index is None:
+            index = self.lookup[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return index
+
+    def nbytes(self):
+        return sum(sys.getsizeof(value) for value in self.values) + sys.getsizeof(self.values)
+
+
+# typed array for a column, numpy when it is installed and the stdlib array module otherwise
+def make_column(kind, values):
+    if numpy is not None:
+        return numpy.array(values, dtype=NUMPY_TYPES[kind])
+    return array.array(ARRAY_TYPES[kind], values)
+
+
+def join_columns(kind, parts):
+    if numpy is not None:
+        return numpy.concatenate([make_column(kind, [])] + parts)
+    joined = make_column(kind, [])
+    for part in parts:
+        joined.extend(part)
+    return joined
+
+
+# offsets for the joined groups, given the offset slice (one longer than the trail count) of each part
+def join_offsets(parts):
+    if numpy is not None:
+        lengths = numpy.concatenate([numpy.diff(part) for part in parts] + [make_column('int', [])])
+        return numpy.concatenate(([0], numpy.cumsum(lengths))).astype(NUMPY_TYPES['int'])
+    offsets = make_column('int', [0])
+    for part in parts:
+        for i in range(1, len(part)):
+            offsets.append(offsets[-1] + part[i] - part[i - 1])
+    return offsets
+
+
+def column_nbytes(values):
+    if numpy is not None:
+        return values.nbytes
+    return values.itemsize * len(values)
+
+
+def find_sorted(values, value):
+    if numpy is not None:
+        return int(numpy.searchsorted(values, value))
+    return bisect.bisect_left(values, value)
+
+
+NUMPY_TYPES = {'bool': 'uint8', 'int': 'int64', 'float': 'float64', 'str': 'int32'}
+ARRAY_TYPES = {'bool': 'B', 'int': 'q', 'float': 'd', 'str': 'l'}
+# checked in this order when a column's kind is inferred, str takes whatever is left
+COLUMN_KINDS = {
+    'bool': lambda value: isinstance(value, bool),
+    'int': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'float': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'str': lambda value: isinstance(value, str),
+}
+
+
+# immutable columnar copy of Trail, Location and trailFeatures
+# locations and features are sorted by trail, with offset arrays giving each trail's slice
+# a snapshot built with a template shares its string table and column kinds, ready to be spliced into it
+class CatalogueSnapshot:
+    def __init__(self, trails, locations, features, template=None):
+        self.strings = StringTable() if template is None else template.strings
+        trail_columns, trail_rows = trails
+        location_columns, location_rows = locations
+        feature_columns, feature_rows = features
+
+        trail_key = column_position(trail_columns, 'trailid')
+        trail_rows = sorted(trail_rows, key=lambda row: row[trail_key])
+        self.trail_ids = make_column('int', [row[trail_key] for row in trail_rows])
+        self.trails = self._table(trail_columns, trail_rows, template and template.trails)
+
+        self.locations, self.location_offsets = self._group(
+            location_columns, location_rows, ('trailid', 'trailorder', 'locationid'), template and template.locations)
+        self.features, self.feature_offsets = self._group(
+            feature_columns, feature_rows, ('trailid', 'featureid'), template and template.features)
+
+    def _table(self, columns, rows, template):
+        if template is None:
+            return ColumnarTable(columns, rows, self.strings)
+        if list(columns) != list(template.columns):
+            raise ValueError("columns have changed since the last full load")
+        return ColumnarTable(columns, rows, self.strings, template.kinds)
+
+    def _group(self, columns, rows, sort_columns, template=None):
+        keys = [column_position(columns, name) for name in sort_columns]
+        known = set(self.trail_ids.tolist())
+        rows = sorted((row for row in rows if row[keys[0]] in known),
+                      key=lambda row: tuple(row[key] for key in keys))
+        table = self._table(columns, rows, template)
+
+        # offsets[i]:offsets[i + 1] is the slice belonging to the i-th trail
+        offsets = [0]
+        position = 0
+        for trailID in self.trail_ids.tolist():
+            while position < len(rows) and rows[position][keys[0]] == trailID:
+                position += 1
+            offsets.append(position)
+        return table, make_column('int', offsets)
+
+    def _position(self, trailID):
+        position = find_sorted(self.trail_ids, trailID)
+        if position < len(self.trail_ids) and self.trail_ids[position] == trailID:
+            return position
+        return None
+
+    def all_trails(self):
+        return self.trails.rows()
+
+    def trail(self, trailID):
+        position = self._position(trailID)
+        return None if position is None else self.trails.rows(position, position + 1)[0]
+
+    def trail_locations(self, trailID):
+        position = self._position(trailID)
+        if position is None:
+            return []
+        return self.locations.rows(int(self.location_offsets[position]), int(self.location_offsets[position + 1]))
+
+    def trail_features(self, trailID):
+        position = self._position(trailID)
+        if position is None:
+            return []
+        return self.features.rows(int(self.feature_offsets[position]), int(self.feature_offsets[position + 1]))
+
+    # a new snapshot with trailIDs replaced by fresh, a snapshot of just those trails built with this one as template
+    # the trails in between are copied across as array slices, so no rows are decoded
+    def splice(self, trailIDs, fresh):
+        removed = {position for position in map(self._position, trailIDs) if position is not None}
+        inserts = [find_sorted(self.trail_ids, trailID) for trailID in fresh.trail_ids.tolist()]
+
+        # (snapshot, first trail position, last trail position + 1) runs in trail order
+        pieces = []
+        position, j = 0, 0
+        for cut in sorted(removed.union(inserts)):
+            if cut > position:
+                pieces.append((self, position, cut))
+            position = max(position, cut)
+            while j < len(inserts) and inserts[j] == cut:
+                if pieces and pieces[-1][0] is fresh:
+                    pieces[-1] = (fresh, pieces[-1][1], j + 1)
+                else:
+                    pieces.append((fresh, j, j + 1))
+                j += 1
+            if cut in removed:
+                position = cut + 1
+        if position < len(self.trail_ids):
+            pieces.append((self, position, len(self.trail_ids)))
+
+        snapshot = CatalogueSnapshot.__new__(CatalogueSnapshot)
+        snapshot.strings = self.strings
+        snapshot.trail_ids = join_columns('int', [source.trail_ids[start:stop] for source, start, stop in pieces])
+        snapshot.trails = ColumnarTable.join(self.trails, [(source.trails, start, stop) for source, start, stop in pieces])
+        snapshot.locations, snapshot.location_offsets = self._splice_group(pieces, 'locations', 'location_offsets')
+        snapshot.features, snapshot.feature_offsets = self._splice_group(pieces, 'features', 'feature_offsets')
+        return snapshot
+
+    def _splice_group(self, pieces, table, offsets):
+        rows, parts = [], []
+        for source, start, stop in pieces:
+            source_offsets = getattr(source, offsets)
+            rows.append((getattr(source, table), int(source_offsets[start]), int(source_offsets[stop])))
+            parts.append(source_offsets[start:stop + 1])
+        return ColumnarTable.join(getattr(self, table), rows), join_offsets(parts)
+
+    def memory(self):
+        tables = {
+            "Trail": self.trails.nbytes() + column_nbytes(self.trail_ids),
+            "Location": self.locations.nbytes() + column_nbytes(self.location_offsets),
+            "trailFeatures": self.features.nbytes() + column_nbytes(self.feature_offsets),
+            "strings": self.strings.nbytes(),
+        }
+        return {
+            "bytes": tables,
+            "totalBytes": sum(tables.values()),
+            "rows": {"Trail": self.trails.length, "Location": self.locations.length,
+                     "trailFeatures": self.features.length},
+            "internedStrings": len(self.strings.values),
+            "backend": "numpy" if numpy is not None else "array",
+        }
+
+
+def column_position(columns, name):
+    return [column.lower() for column in columns].index(name)
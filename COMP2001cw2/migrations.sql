@@ -0,0 +1,44 @@
+-- schema changes for TrailService, safe to run more than once
+
+-- change feed for offline clients (GET /api/changes)
+-- seq is the sync cursor, deletes are kept as tombstones with op = 'delete' and no payload
+IF OBJECT_ID('dbo.ChangeLog', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.ChangeLog (
+        seq BIGINT IDENTITY(1, 1) NOT NULL PRIMARY KEY,
+        entity VARCHAR(16) NOT NULL, -- Trail, Location or Feature
+        op VARCHAR(8) NOT NULL, -- upsert or delete
+        trailID INT NOT NULL,
+        entityID INT NOT NULL, -- TrailID, LocationID or featureID
+        payload NVARCHAR(MAX) NULL, -- JSON of the new values
+        changedAt DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+END
+GO
+
+-- covering indexes for the visibility-aware trail listing (GET /api/trails and /api/trails/mine)
+-- public trails are read with a seek on isPublic, the caller's own with a seek on userID
+-- to compare before and after, run the two queries below with the statistics on, create the
+-- indexes, then run them again and compare the logical reads and elapsed time in the messages
+--
+-- SET STATISTICS IO ON;
+-- SET STATISTICS TIME ON;
+-- SELECT * FROM Trail WHERE isPublic = 1 UNION ALL SELECT * FROM Trail WHERE userID = 1 AND isPublic = 0;
+-- SELECT * FROM Trail WHERE userID = 1;
+-- SET STATISTICS IO OFF;
+-- SET STATISTICS TIME OFF;
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Trail_isPublic_TrailID' AND object_id = OBJECT_ID('dbo.Trail'))
+BEGIN
+    CREATE NONCLUSTERED INDEX IX_Trail_isPublic_TrailID
+        ON dbo.Trail (isPublic, TrailID)
+        INCLUDE (name, description, elevationGain, estTime, loop, userID);
+END
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Trail_userID_TrailID' AND object_id = OBJECT_ID('dbo.Trail'))
+BEGIN
+    CREATE NONCLUSTERED INDEX IX_Trail_userID_TrailID
+        ON dbo.Trail (userID, TrailID)
+        INCLUDE (name, description, elevationGain, estTime, loop, isPublic);
+END
+GO
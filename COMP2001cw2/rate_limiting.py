@@ -0,0 +1,35 @@
+# per-client request limiting, kept free of Flask so it can be tested on its own
+import threading
+import time
+
+
+# token buckets split over several independently locked shards so requests rarely wait on each other
+class TokenBucketLimiter:
+    def __init__(self, shards=16, clock=time.monotonic, max_buckets=10000):
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.clock = clock
+        self.max_buckets = max_buckets # per shard
+
+    # take `cost` tokens, returns 0 if allowed or the seconds to wait until it would be
+    def take(self, key, rate, burst, cost=1):
+        buckets, lock = self.shards[hash(key) % len(self.shards)]
+        now = self.clock()
+        with lock:
+            tokens, last = buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= cost
+            buckets[key] = (tokens - cost if allowed else tokens, now)
+            # keys come from the client (the username), so the table is kept bounded even when every take succeeds
+            if len(buckets) > self.max_buckets:
+                self._prune(buckets, now)
+            return 0 if allowed else (cost - tokens) / rate
+
+    def _prune(self, buckets, now):
+        # buckets untouched for a minute are full again, so forgetting them changes nothing
+        for key in [key for key, (_, last) in buckets.items() if now - last > 60]:
+            del buckets[key]
+        # still too many, e.g. a flood of made-up usernames: forget the least recently used half
+        keep = self.max_buckets // 2
+        if len(buckets) > keep:
+            for key in sorted(buckets, key=lambda key: buckets[key][1])[:len(buckets) - keep]:
+                del buckets[key]
@@ -0,0 +1,95 @@
+# tests for single-flight request coalescing
+# run with: python -m pytest
+import threading
+import time
+
+import pytest
+
+from coalescing import SingleFlight
+
+
+# starts `count` threads calling flight.do(key, load), results and errors fill in as they finish
+def run_concurrently(flight, key, load, count):
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(flight.do(key, load))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def wait_for_followers(flight, count):
+    for _ in range(1000):
+        if flight.metrics()["coalesced"] >= count:
+            return
+        time.sleep(0.005)
+    raise AssertionError("followers never joined the flight")
+
+
+def test_concurrent_calls_share_one_load():
+    flight = SingleFlight()
+    release = threading.Event()
+    loads = []
+
+    def load():
+        loads.append(1)
+        release.wait(5)
+        return {"trail": 1}
+
+    threads, results, errors = run_concurrently(flight, "trail 1", load, 5)
+    wait_for_followers(flight, 4)
+    assert flight.metrics()["inFlight"] == 1
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert loads == [1] and errors == []
+    assert len(results) == 5 and all(result is results[0] for result in results)
+    assert flight.metrics() == {"executed": 1, "coalesced": 4, "inFlight": 0}
+
+
+def test_followers_get_the_leaders_exception():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def load():
+        release.wait(5)
+        raise ValueError("database went away")
+
+    threads, results, errors = run_concurrently(flight, "trail 1", load, 3)
+    wait_for_followers(flight, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [] and len(errors) == 3
+    assert all(error is errors[0] for error in errors)
+
+
+def test_nothing_is_cached_after_the_flight():
+    flight = SingleFlight()
+    values = iter([1, 2])
+    assert flight.do("key", lambda: next(values)) == 1
+    assert flight.do("key", lambda: next(values)) == 2
+    with pytest.raises(KeyError):
+        flight.do("key", lambda: {}["missing"])
+    assert flight.do("key", lambda: 3) == 3
+    assert flight.metrics() == {"executed": 4, "coalesced": 0, "inFlight": 0}
+
+
+def test_different_keys_do_not_wait_on_each_other():
+    flight = SingleFlight()
+    release = threading.Event()
+    threads, results, _ = run_concurrently(flight, "slow", lambda: release.wait(5) and "slow", 1)
+    for _ in range(1000):
+        if flight.metrics()["inFlight"]:
+            break
+        time.sleep(0.005)
+    assert flight.do("fast", lambda: "fast") == "fast"
+    release.set()
+    threads[0].join()
+    assert results == ["slow"]
@@ -0,0 +1,129 @@
+# tests for the columnar catalogue snapshot, run against numpy when it is installed and the array module fallback
+# run with: python -m pytest
+import random
+
+import pytest
+
+import columnar
+from columnar import CatalogueSnapshot, ColumnarTable, StringTable
+
+TRAIL_COLUMNS = ["TrailID", "name", "isPublic", "length"]
+LOCATION_COLUMNS = ["LocationID", "trailID", "trailOrder", "latitude"]
+FEATURE_COLUMNS = ["trailID", "featureID", "feature"]
+
+
+@pytest.fixture(params=["numpy", "array"], autouse=True)
+def backend(request, monkeypatch):
+    if request.param == "numpy" and columnar.numpy is None:
+        pytest.skip("numpy isn't installed")
+    if request.param == "array":
+        monkeypatch.setattr(columnar, "numpy", None)
+    return request.param
+
+
+def snapshot(trails, locations, features, template=None):
+    return CatalogueSnapshot((TRAIL_COLUMNS, trails), (LOCATION_COLUMNS, locations), (FEATURE_COLUMNS, features),
+                             template=template)
+
+
+@pytest.fixture
+def catalogue():
+    return snapshot(
+        [(3, "Burrator", True, 5.5), (1, "Dartmoor", None, 2.0), (2, None, False, None)],
+        [(12, 1, 2, 50.2), (11, 1, 1, 50.1), (30, 3, 1, None), (99, 7, 1, 50.0)],
+        [(3, 2, "Parking"), (1, 1, "Waterfall")]
+    )
+
+
+def test_table_round_trips_types_and_nulls():
+    table = ColumnarTable(["id", "name", "flag", "score"], [(1, "a", True, 1.5), (2, None, None, 2), (3, "a", False, None)],
+                          StringTable())
+    assert table.kinds == ["int", "str", "bool", "float"]
+    assert table.rows() == [{"id": 1, "name": "a", "flag": True, "score": 1.5},
+                            {"id": 2, "name": None, "flag": None, "score": 2.0},
+                            {"id": 3, "name": "a", "flag": False, "score": None}]
+    assert table.rows(1, 2) == [table.rows()[1]]
+    assert table.strings.values == ["a"]
+
+
+def test_table_refuses_values_of_another_kind():
+    strings = StringTable()
+    table = ColumnarTable(["id"], [(1,)], strings)
+    with pytest.raises(ValueError):
+        ColumnarTable(["id"], [("one",)], strings, table.kinds)
+
+
+def test_join_copies_row_ranges_with_their_nulls():
+    strings = StringTable()
+    left = ColumnarTable(["id", "name"], [(1, "a"), (2, None), (3, "c")], strings)
+    right = ColumnarTable(["id", "name"], [(None, "d"), (5, None)], strings, left.kinds)
+    joined = ColumnarTable.join(left, [(left, 1, 3), (right, 0, 2), (left, 0, 1)])
+    assert joined.rows() == left.rows(1, 3) + right.rows() + left.rows(0, 1)
+
+
+def test_snapshot_lookups(catalogue):
+    assert [trail["TrailID"] for trail in catalogue.all_trails()] == [1, 2, 3]
+    assert catalogue.trail(2) == {"TrailID": 2, "name": None, "isPublic": False, "length": None}
+    assert catalogue.trail(4) is None
+    assert [location["LocationID"] for location in catalogue.trail_locations(1)] == [11, 12]
+    assert catalogue.trail_locations(2) == []
+    assert catalogue.trail_features(3) == [{"trailID": 3, "featureID": 2, "feature": "Parking"}]
+    # rows of a trail that isn't in Trail are left out
+    assert catalogue.trail_locations(7) == []
+    assert catalogue.memory()["rows"] == {"Trail": 3, "Location": 3, "trailFeatures": 2}
+
+
+def test_splice_replaces_removes_and_adds_trails(catalogue):
+    fresh = snapshot([(1, "Dartmoor Loop", True, 2.5), (4, "Hoe", True, 1.0)], [(40, 4, 1, 50.4)], [],
+                     template=catalogue)
+    spliced = catalogue.splice({1, 3, 4}, fresh)
+    assert [trail["name"] for trail in spliced.all_trails()] == ["Dartmoor Loop", None, "Hoe"]
+    assert spliced.trail_locations(1) == [] and spliced.trail_features(1) == []
+    assert spliced.trail(3) is None
+    assert [location["LocationID"] for location in spliced.trail_locations(4)] == [40]
+    # the old snapshot is left as it was for readers still holding it
+    assert catalogue.trail(1)["name"] == "Dartmoor"
+
+
+def test_splice_refuses_a_changed_column_kind(catalogue):
+    with pytest.raises(ValueError):
+        snapshot([(1, "Dartmoor", "yes", 2.0)], [], [], template=catalogue)
+
+
+def random_rows(rnd, trailIDs):
+    trails, locations, features = [], [], []
+    for trailID in trailIDs:
+        trails.append((trailID, rnd.choice(["a", "b", None, f"trail {trailID}"]), rnd.choice([True, False, None]),
+                       rnd.choice([1.5, 2.0, None])))
+        for order in rnd.sample(range(10), rnd.randint(0, 4)):
+            locations.append((trailID * 100 + order, trailID, order, rnd.choice([50.1, None])))
+        for i in range(rnd.randint(0, 2)):
+            features.append((trailID, trailID * 10 + i, rnd.choice(["x", "y", None])))
+    return trails, locations, features
+
+
+def test_splice_matches_a_full_rebuild():
+    rnd = random.Random(2001)
+    for _ in range(200):
+        trailIDs = rnd.sample(range(1, 40), rnd.randint(0, 15))
+        trails, locations, features = random_rows(rnd, trailIDs)
+        old = snapshot(trails, locations, features)
+
+        # dirty trails are deleted, or reloaded with new rows, and may not have existed before
+        dirty = set(rnd.sample(range(1, 45), rnd.randint(0, 6)))
+        fresh_rows = random_rows(rnd, [trailID for trailID in dirty if rnd.random() < 0.6])
+        try:
+            fresh = snapshot(*fresh_rows, template=old)
+        except ValueError:
+            continue # a column changed kind, the catalogue does a full load instead
+        spliced = old.splice(dirty, fresh)
+        full = snapshot([row for row in trails if row[0] not in dirty] + fresh_rows[0],
+                        [row for row in locations if row[1] not in dirty] + fresh_rows[1],
+                        [row for row in features if row[0] not in dirty] + fresh_rows[2])
+
+        assert spliced.all_trails() == full.all_trails()
+        assert list(spliced.location_offsets) == list(full.location_offsets)
+        assert list(spliced.feature_offsets) == list(full.feature_offsets)
+        for trailID in set(trailIDs) | dirty:
+            assert spliced.trail_locations(trailID) == full.trail_locations(trailID)
+            assert spliced.trail_features(trailID) == full.trail_features(trailID)
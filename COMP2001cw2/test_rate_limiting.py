@@ -0,0 +1,70 @@
+# tests for the token bucket limiter, time is driven by hand
+# run with: python -m pytest
+import pytest
+
+from rate_limiting import TokenBucketLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_burst_then_wait(clock):
+    limiter = TokenBucketLimiter(clock=clock)
+    assert [limiter.take("alice", 2, 3) for _ in range(3)] == [0, 0, 0]
+    assert limiter.take("alice", 2, 3) == pytest.approx(0.5)
+    # a refused take doesn't use up anything
+    assert limiter.take("alice", 2, 3) == pytest.approx(0.5)
+
+
+def test_tokens_refill_up_to_the_burst(clock):
+    limiter = TokenBucketLimiter(clock=clock)
+    for _ in range(3):
+        limiter.take("alice", 2, 3)
+    clock.now += 0.5
+    assert limiter.take("alice", 2, 3) == 0
+    assert limiter.take("alice", 2, 3) > 0
+    clock.now += 60
+    assert [limiter.take("alice", 2, 3) for _ in range(4)][-1] > 0
+
+
+def test_keys_and_costs(clock):
+    limiter = TokenBucketLimiter(shards=1, clock=clock)
+    assert limiter.take(("alice", "get_trails"), 1, 5, cost=5) == 0
+    assert limiter.take(("alice", "get_trails"), 1, 5, cost=2) == pytest.approx(2)
+    assert limiter.take(("alice", "*"), 1, 5) == 0
+    assert limiter.take(("bob", "get_trails"), 1, 5) == 0
+
+
+def test_table_stays_bounded_and_keeps_busy_clients(clock):
+    limiter = TokenBucketLimiter(shards=1, clock=clock, max_buckets=100)
+    buckets = limiter.shards[0][0]
+    limiter.take("alice", 1, 2)
+    limiter.take("alice", 1, 2)
+    for i in range(1000):
+        clock.now += 0.001
+        limiter.take(f"made-up {i}", 1, 2)
+        if i % 10 == 0:
+            limiter.take("alice", 1, 2)
+    assert len(buckets) <= 100
+    assert "alice" in buckets
+    # alice's bucket survived, so she is still limited rather than handed a fresh burst
+    assert limiter.take("alice", 1, 2) > 0
+
+
+def test_stale_buckets_are_forgotten_first(clock):
+    limiter = TokenBucketLimiter(shards=1, clock=clock, max_buckets=10)
+    for i in range(10):
+        limiter.take(i, 1, 2)
+    clock.now += 120
+    limiter.take("new", 1, 2)
+    assert list(limiter.shards[0][0]) == ["new"]
@@ -0,0 +1,265 @@
+# tests for the search, facet, route graph and encoding structures, no database needed
+# run with: python -m pytest
+import array
+import random
+
+import pytest
+
+from trail_engines import (DELTA_HEADER, DELTA_MAGIC, RouteGraph, TrailFacetIndex, TrailSearchIndex,
+                           encode_delta, encode_polyline, haversine)
+
+
+# search index
+
+@pytest.fixture
+def search_index():
+    index = TrailSearchIndex()
+    index.load(
+        [(1, "Dartmoor Waterfall Walk", "A loop past the waterfall", True, 10),
+         (2, "Plymouth Hoe", "Coastal walk by the sea", True, 11),
+         (3, "Burrator Reservoir", "Flat path around the reservoir", True, 10)],
+        [(2, 1, "Parking"), (1, 2, "Waterfall"), (3, 3, "Parking")]
+    )
+    return index
+
+
+def test_tokenise_drops_stopwords_and_case():
+    assert TrailSearchIndex.tokenise("The Walk to the SEA") == ["walk", "sea"]
+    assert TrailSearchIndex.tokenise(None) == []
+
+
+def test_search_ranks_name_match_first(search_index):
+    results = search_index.search("waterfall")
+    assert [result["trailID"] for result in results] == [1]
+    assert results[0]["features"] == ["Waterfall"]
+
+
+def test_search_matches_last_word_as_prefix(search_index):
+    assert [result["trailID"] for result in search_index.search("reserv")] == [3]
+
+
+def test_search_matches_misspelling_by_trigrams(search_index):
+    assert 2 in [result["trailID"] for result in search_index.search("coastl")]
+
+
+def test_search_limit_and_empty_query(search_index):
+    assert len(search_index.search("parking", limit=1)) == 1
+    assert search_index.search("the and") == []
+
+
+def test_search_feature_updates_and_removal(search_index):
+    search_index.remove_feature(2, 1)
+    assert [result["trailID"] for result in search_index.search("parking")] == [3]
+    search_index.set_feature(2, 1, "Cafe")
+    assert [result["trailID"] for result in search_index.search("cafe")] == [2]
+
+
+def test_search_remove_trail_cleans_up_terms(search_index):
+    search_index.remove_trail(1)
+    assert search_index.search("dartmoor") == []
+    assert "dartmoor" not in search_index.sorted_terms
+    assert all("dartmoor" not in terms for terms in search_index.trigrams.values())
+
+
+def test_search_update_trail_ignores_unknown_trail(search_index):
+    search_index.update_trail(99, "Ghost", "Not there", True)
+    assert search_index.search("ghost") == []
+
+
+def test_search_hides_private_trails_from_other_users(search_index):
+    search_index.add_trail(4, "Secret Waterfall", "Only for me", None, 11)
+    search_index.update_trail(3, "Burrator Reservoir", "Flat path around the reservoir", False)
+    assert [result["trailID"] for result in search_index.search("waterfall", viewer=10)] == [1]
+    assert [result["trailID"] for result in search_index.search("waterfall", viewer=11)] == [1, 4]
+    assert [result["trailID"] for result in search_index.search("reservoir", viewer=10)] == [3]
+    assert search_index.search("reservoir", viewer=11) == []
+    assert len(search_index.search("waterfall")) == 2
+
+
+# facet index
+
+@pytest.fixture
+def facet_index():
+    index = TrailFacetIndex()
+    index.load(
+        [(3, True, True, 10), (1, True, False, 11), (2, False, True, 11)],
+        [(1, 1, "Waterfall"), (3, 2, "waterfall"), (3, 3, "Parking"), (2, 4, "Parking")]
+    )
+    return index
+
+
+def test_intersect_and_union():
+    left = array.array('l', [1, 3, 5, 7])
+    right = array.array('l', [3, 4, 5, 8])
+    assert list(TrailFacetIndex.intersect(left, right)) == [3, 5]
+    assert list(TrailFacetIndex.union(left, right)) == [1, 3, 4, 5, 7, 8]
+    assert list(TrailFacetIndex.intersect(left, array.array('l'))) == []
+
+
+def test_facet_and_query_with_flags(facet_index):
+    trailIDs, facets, flags = facet_index.query(all_features=["Waterfall", "parking"], isPublic=True, loop=True)
+    assert trailIDs == [3]
+    assert facets == {"Waterfall": 1, "Parking": 1}
+    assert flags == {"isPublic": 1, "loop": 1}
+
+
+def test_facet_or_query_and_false_flag(facet_index):
+    trailIDs, facets, _ = facet_index.query(any_features=["waterfall", "parking"], loop=False)
+    assert trailIDs == [1]
+    assert facets == {"Waterfall": 1}
+
+
+def test_facet_counts_cover_every_match(facet_index):
+    trailIDs, facets, flags = facet_index.query()
+    assert trailIDs == [1, 2, 3]
+    assert facets == {"Waterfall": 2, "Parking": 2}
+    assert flags == {"isPublic": 2, "loop": 2}
+
+
+def test_facet_duplicate_feature_text_needs_both_removed(facet_index):
+    facet_index.set_feature(3, 5, "Parking")
+    facet_index.remove_feature(3, 3)
+    assert facet_index.query(all_features=["parking"])[0] == [2, 3]
+    facet_index.remove_feature(3, 5)
+    assert facet_index.query(all_features=["parking"])[0] == [2]
+
+
+def test_facet_ignores_features_of_unknown_trails(facet_index):
+    facet_index.set_feature(99, 6, "Cafe")
+    assert facet_index.query(all_features=["cafe"])[0] == []
+
+
+def test_facet_remove_trail(facet_index):
+    facet_index.remove_trail(3)
+    trailIDs, facets, _ = facet_index.query()
+    assert trailIDs == [1, 2]
+    assert 3 not in facet_index.trail_features
+    assert 10 not in facet_index.owners
+
+
+def test_facet_viewer_sees_public_and_own_trails(facet_index):
+    trailIDs, facets, flags = facet_index.query(viewer=10)
+    assert trailIDs == [1, 3]
+    assert facets == {"Waterfall": 2, "Parking": 1}
+    assert flags == {"isPublic": 2, "loop": 1}
+    assert facet_index.query(isPublic=False, viewer=10)[0] == []
+    assert facet_index.query(isPublic=False, viewer=11)[0] == [2]
+
+
+def test_facet_set_trail_keeps_owner_unless_given(facet_index):
+    facet_index.set_trail(2, None, True)
+    assert facet_index.query(viewer=11)[0] == [1, 2, 3]
+    facet_index.set_trail(2, None, True, 12)
+    assert facet_index.query(viewer=11)[0] == [1, 3]
+    assert facet_index.query(viewer=12)[0] == [1, 2, 3]
+
+
+# route graph
+
+DEGREE = 0.009 # roughly 1 km of latitude
+
+
+@pytest.fixture
+def graph():
+    # a rectangle walked by two trails, plus a spur that starts within a few metres of its corner
+    return RouteGraph({
+        1: [(1, 50.0, -4.0), (2, 50.0 + DEGREE, -4.0), (3, 50.0 + DEGREE, -4.0 + DEGREE * 1.5)],
+        2: [(4, 50.0 + DEGREE, -4.0 + DEGREE * 1.5), (5, 50.0, -4.0 + DEGREE * 1.5), (6, 50.0, -4.0)],
+        3: [(7, 50.00005, -4.00005), (8, 50.0 - DEGREE, -4.0)],
+    }, join_radius=25)
+
+
+def test_haversine_one_degree_of_latitude():
+    assert haversine(50.0, -4.0, 51.0, -4.0) == pytest.approx(111195, rel=1e-3)
+
+
+def test_graph_joins_nearby_points(graph):
+    assert len(graph.node_lat) == 5
+    assert graph.location_nodes[1] == graph.location_nodes[6] == graph.location_nodes[7]
+    assert graph.location_nodes[3] == graph.location_nodes[4]
+    # every edge is stored in both directions
+    assert len(graph.targets) == 2 * 5
+    assert graph.offsets[-1] == len(graph.targets)
+
+
+def test_graph_shortest_path_crosses_trails(graph):
+    nodes, edges = graph.shortest_path(graph.location_nodes[8], graph.location_nodes[3])
+    route = graph.describe(nodes, edges)
+    assert route["trails"][0] == 3
+    assert route["distanceKm"] == pytest.approx(2.97, abs=0.01)
+    assert nodes[0] == graph.location_nodes[8] and nodes[-1] == graph.location_nodes[3]
+
+
+def test_graph_shortest_path_unreachable():
+    graph = RouteGraph({1: [(1, 50.0, -4.0), (2, 50.01, -4.0)], 2: [(3, 51.0, -4.0), (4, 51.01, -4.0)]}, 25)
+    assert graph.shortest_path(graph.location_nodes[1], graph.location_nodes[3]) is None
+
+
+def test_graph_loop_goes_round_without_retracing(graph):
+    start = graph.location_nodes[1]
+    nodes, edges = graph.loop(start, 4000)
+    route = graph.describe(nodes, edges)
+    assert nodes[0] == nodes[-1] == start
+    assert route["distanceKm"] == pytest.approx(3.93, abs=0.05)
+    assert route["trails"] == [1, 2]
+
+
+def test_graph_nearest_node(graph):
+    assert graph.nearest_node(50.0091, -4.0001) == graph.location_nodes[2]
+    # well outside the network, past the grid search's rings
+    assert graph.nearest_node(50.0 - DEGREE * 40, -4.0) == graph.location_nodes[8]
+    assert RouteGraph({}, 25).nearest_node(50.0, -4.0) is None
+
+
+def test_graph_nearest_node_matches_a_full_scan():
+    rnd = random.Random(36)
+    for latitude, longitude in ((50.4, -4.1), (-33.9, 151.2), (69.6, 18.9)):
+        points = {trailID: [(trailID * 100 + i, latitude + rnd.uniform(-0.05, 0.05), longitude + rnd.uniform(-0.05, 0.05))
+                            for i in range(30)] for trailID in range(20)}
+        graph = RouteGraph(points, 25)
+        for _ in range(50):
+            query = (latitude + rnd.uniform(-0.2, 0.2), longitude + rnd.uniform(-0.2, 0.2))
+            nearest = min(haversine(graph.node_lat[node], graph.node_lon[node], *query)
+                          for node in range(len(graph.node_lat)))
+            found = graph.nearest_node(*query)
+            assert haversine(graph.node_lat[found], graph.node_lon[found], *query) == pytest.approx(nearest)
+
+
+# location encodings
+
+def test_polyline_matches_reference_example():
+    # the worked example from Google's encoded polyline documentation
+    assert encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+
+def read_varints(data, position):
+    values = []
+    while position < len(data):
+        value, shift = 0, 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        values.append((value >> 1) ^ -(value & 1))
+    return values
+
+
+def test_delta_encoding_round_trips():
+    columns = {"trailID": 7, "LocationID": [10, 11, 15], "trailOrder": [1, 2, 3],
+               "latitude": [50.37, 50.3701, 50.3699], "longitude": [-4.14, -4.1401, -4.1399]}
+    data = encode_delta(columns)
+    magic, version, trailID, count = DELTA_HEADER.unpack_from(data)
+    assert (magic, version, trailID, count) == (DELTA_MAGIC, 1, 7, 3)
+
+    deltas = read_varints(data, DELTA_HEADER.size)
+    values, previous = [], [0, 0, 0, 0]
+    for i in range(0, len(deltas), 4):
+        previous = [previous[j] + deltas[i + j] for j in range(4)]
+        values.append(previous)
+    assert [value[0] for value in values] == columns["LocationID"]
+    assert [value[1] for value in values] == columns["trailOrder"]
+    assert [value[2] / 1e6 for value in values] == pytest.approx(columns["latitude"])
+    assert [value[3] / 1e6 for value in values] == pytest.approx(columns["longitude"])
@@ -0,0 +1,228 @@
+# tests for the location write-behind buffer against a fake database connection
+# run with: python -m pytest
+import json
+
+import pytest
+
+import write_behind
+from write_behind import LocationWriteBuffer
+
+
+class RowError(Exception):
+    pass
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+# just enough of a DB-API connection for the buffer, `fail(params)` returns an exception to raise or None
+class FakeDatabase:
+    def __init__(self):
+        self.rows = [] # committed (trailID, locationID or None, trailOrder)
+        self.changes = [] # committed change feed rows
+        self.fail = None
+        self.next_id = 100
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def record_changes(self, cursor, changes):
+        cursor.connection.staged_changes.extend(changes)
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.staged = []
+        self.staged_changes = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.rows.extend(self.staged)
+        self.db.changes.extend(self.staged_changes)
+        self.rollback()
+
+    def rollback(self):
+        self.staged, self.staged_changes = [], []
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, sql, params):
+        error = self.connection.db.fail(params) if self.connection.db.fail else None
+        if error is not None:
+            raise error
+        if sql.startswith("UPDATE"):
+            self.connection.staged.append((params[3], params[4], params[2]))
+        else:
+            self.connection.staged.append((params[0], None, params[3]))
+        self.rowcount = 1
+
+    def fetchone(self):
+        self.connection.db.next_id += 1
+        return (self.connection.db.next_id,)
+
+
+@pytest.fixture
+def db():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def make_buffer(db, tmp_path):
+    buffers = []
+
+    def make(flushed=None):
+        buffer = LocationWriteBuffer(str(tmp_path / "journal.log"), 1000, 60, db.connect, db.record_changes,
+                                     (RowError,), flushed)
+        buffers.append(buffer)
+        return buffer
+
+    yield make
+    db.fail = None
+    for buffer in buffers:
+        if buffer.thread is not None:
+            buffer.stop()
+
+
+def test_updates_to_the_same_location_coalesce(db, make_buffer):
+    flushed = []
+    buffer = make_buffer(flushed.extend)
+    assert buffer.start()
+    buffer.enqueue_update(1, 10, -4.1, 50.3, 1)
+    buffer.enqueue_update(1, 10, -4.2, 50.4, 2)
+    buffer.enqueue_create(2, -4.3, 50.5, 1)
+    assert buffer.flush() == 2
+    assert db.rows == [(1, 10, 2), (2, None, 1)]
+    assert [change[3] for change in db.changes] == [10, 101]
+    assert flushed == [1, 2]
+    assert buffer.metrics()["coalesced"] == 1
+
+
+def test_restart_replays_only_unflushed_writes(db, make_buffer, tmp_path):
+    # no flush thread, so nothing is written behind the test's back before the crash
+    buffer = make_buffer()
+    buffer.journal = open(str(tmp_path / "journal.log"), 'a', encoding='utf-8')
+    buffer.enqueue_update(1, 10, -4.1, 50.3, 1)
+    buffer.flush()
+    buffer.enqueue_update(1, 11, -4.1, 50.3, 2)
+    buffer.enqueue_create(1, -4.1, 50.3, 3)
+    # crash part way through writing a third line
+    buffer.journal.write('{"op": "upd')
+    buffer.journal.close()
+
+    restarted = make_buffer()
+    assert restarted.start()
+    assert list(restarted.updates) == [(1, 11)]
+    assert [entry["trailOrder"] for entry in restarted.creates] == [3]
+    assert restarted.seq == buffer.seq
+    restarted.flush()
+    assert db.rows == [(1, 10, 1), (1, 11, 2), (1, None, 3)]
+
+
+def test_replay_skips_writes_covered_by_a_flushed_marker(make_buffer, tmp_path):
+    # a crash after the marker was written but before the journal was compacted
+    entries = [{"op": "update", "trailID": 1, "locationID": 10, "longitude": -4.1, "latitude": 50.3, "trailOrder": 1,
+                "seq": 1},
+               {"op": "create", "trailID": 1, "longitude": -4.1, "latitude": 50.3, "trailOrder": 2, "seq": 2},
+               {"op": "update", "trailID": 1, "locationID": 11, "longitude": -4.1, "latitude": 50.3, "trailOrder": 3,
+                "seq": 3},
+               {"op": "flushed", "upTo": 2, "seq": 4}]
+    (tmp_path / "journal.log").write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    buffer = make_buffer()
+    buffer.start()
+    assert list(buffer.updates) == [(1, 11)] and buffer.creates == []
+    assert buffer.seq == 3
+
+
+def test_flush_compacts_the_journal(make_buffer, tmp_path):
+    buffer = make_buffer()
+    buffer.start()
+    buffer.enqueue_update(1, 10, -4.1, 50.3, 1)
+    buffer.flush()
+    assert (tmp_path / "journal.log").read_text() == ""
+
+
+def test_rejected_rows_are_dead_lettered_before_a_connection_failure(db, make_buffer, tmp_path):
+    buffer = make_buffer()
+    buffer.start()
+    for locationID in (1, 2, 3, 4):
+        buffer.enqueue_update(1, locationID, -4.1, 50.3, locationID)
+    lost = []
+
+    # the batch fails on row 1, then the row-at-a-time retry loses the connection at row 3
+    def fail(params):
+        if params[4] == 1:
+            return RowError("bad row")
+        if params[4] == 3 and not lost:
+            lost.append(params)
+            return ConnectionLost("gone")
+    db.fail = fail
+    with pytest.raises(ConnectionLost):
+        buffer.flush()
+
+    dead = [json.loads(line) for line in (tmp_path / "journal.log.dead").read_text().splitlines()]
+    assert [line["entry"]["locationID"] for line in dead] == [1]
+    assert dead[0]["error"] == "bad row"
+    assert db.rows == [(1, 2, 2)]
+    assert sorted(buffer.updates) == [(1, 3), (1, 4)]
+    assert buffer.metrics()["deadLettered"] == 1
+
+    assert buffer.flush() == 2
+    assert db.rows == [(1, 2, 2), (1, 3, 3), (1, 4, 4)]
+
+
+def test_other_errors_requeue_the_whole_batch(db, make_buffer, tmp_path):
+    buffer = make_buffer()
+    buffer.start()
+    buffer.enqueue_update(1, 10, -4.1, 50.3, 1)
+    buffer.enqueue_create(1, -4.1, 50.3, 2)
+    db.fail = lambda params: ConnectionLost("no ChangeLog table")
+    with pytest.raises(ConnectionLost):
+        buffer.flush()
+    assert not (tmp_path / "journal.log.dead").exists()
+    assert list(buffer.updates) == [(1, 10)] and len(buffer.creates) == 1
+    assert buffer.metrics()["failedFlushes"] == 1
+
+
+def test_newer_write_wins_over_a_requeued_one(db, make_buffer):
+    buffer = make_buffer()
+    buffer.start()
+    buffer.enqueue_update(1, 10, -4.1, 50.3, 1)
+
+    def fail(params):
+        # a device sends a newer position while the flush is in flight
+        buffer.enqueue_update(1, 10, -4.2, 50.4, 2)
+        return ConnectionLost("gone")
+    db.fail = fail
+    with pytest.raises(ConnectionLost):
+        buffer.flush()
+    assert buffer.updates[(1, 10)]["trailOrder"] == 2
+
+
+def test_discard_drops_pending_writes(db, make_buffer):
+    buffer = make_buffer()
+    buffer.start()
+    buffer.enqueue_update(1, 10, -4.1, 50.3, 1)
+    buffer.enqueue_update(1, 11, -4.1, 50.3, 2)
+    buffer.enqueue_create(1, -4.1, 50.3, 3)
+    buffer.enqueue_update(2, 20, -4.1, 50.3, 1)
+    buffer.discard(1, 10)
+    assert sorted(buffer.updates) == [(1, 11), (2, 20)]
+    buffer.discard(1)
+    assert list(buffer.updates) == [(2, 20)] and buffer.creates == []
+
+
+@pytest.mark.skipif(write_behind.fcntl is None, reason="journal locking needs fcntl")
+def test_only_one_buffer_owns_the_journal(make_buffer):
+    assert make_buffer().start()
+    assert not make_buffer().start()
@@ -0,0 +1,621 @@
+# data structures behind search, facets, route planning and the compact location formats
+# kept free of Flask and the database so they can be tested on their own, app.py loads and serves them
+import array
+import bisect
+import heapq
+import math
+import re
+import struct
+import threading
+
+
+# in-process full-text index over trail names, descriptions and features
+# postings are term -> {trailID: weighted term count}, ranked with BM25
+# partial words are matched by prefix (sorted term list) and misspellings by trigram overlap
+# each doc keeps isPublic and its owner so results can be limited to what the caller may see
+class TrailSearchIndex:
+    FIELD_WEIGHTS = {"name": 3.0, "description": 1.0, "feature": 2.0}
+    STOPWORDS = {"a", "an", "and", "at", "by", "for", "in", "is", "of", "on", "or", "the", "to", "with"}
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built = False
+        self.docs = {} # trailID -> {"name", "description", "isPublic", "userID", "features": {featureID: feature}}
+        self.postings = {} # term -> {trailID: weighted tf}
+        self.doc_terms = {} # trailID -> {term: weighted tf}, used to remove a trail's postings
+        self.doc_lengths = {} # trailID -> weighted length
+        self.total_length = 0.0
+        self.sorted_terms = [] # for prefix lookups
+        self.trigrams = {} # trigram -> set of terms
+
+    @staticmethod
+    def tokenise(text):
+        if not text:
+            return []
+        return [token for token in TOKEN_PATTERN.findall(str(text).casefold())
+                if token not in TrailSearchIndex.STOPWORDS]
+
+    @staticmethod
+    def term_trigrams(term):
+        padded = f"  {term} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    # replace the whole index, trails are (TrailID, name, description, isPublic, userID)
+    # and features (trailID, featureID, feature)
+    def load(self, trails, features):
+        docs = {row[0]: {"name": row[1], "description": row[2], "isPublic": bool(row[3]), "userID": row[4],
+                         "features": {}} for row in trails}
+        for trailID, featureID, feature in features:
+            if trailID in docs:
+                docs[trailID]["features"][featureID] = feature
+
+        with self.lock:
+            self.docs, self.postings, self.doc_terms, self.doc_lengths = {}, {}, {}, {}
+            self.total_length = 0.0
+            self.sorted_terms, self.trigrams = [], {}
+            for trailID, doc in docs.items():
+                self.docs[trailID] = doc
+                self._index(trailID)
+            self.built = True
+
+    def add_trail(self, trailID, name, description, isPublic, userID):
+        with self.lock:
+            self._unindex(trailID)
+            self.docs[trailID] = {"name": name, "description": description, "isPublic": bool(isPublic),
+                                  "userID": userID, "features": {}}
+            self._index(trailID)
+
+    def update_trail(self, trailID, name, description, isPublic):
+        with self.lock:
+            doc = self.docs.get(trailID)
+            if doc is None:
+                return
+            self._unindex(trailID)
+            doc["name"], doc["description"], doc["isPublic"] = name, description, bool(isPublic)
+            self._index(trailID)
+
+    def remove_trail(self, trailID):
+        with self.lock:
+            self._unindex(trailID)
+            self.docs.pop(trailID, None)
+
+    def set_feature(self, trailID, featureID, feature):
+        with self.lock:
+            doc = self.docs.get(trailID)
+            if doc is None:
+                return
+            self._unindex(trailID)
+            doc["features"][featureID] = feature
+            self._index(trailID)
+
+    def remove_feature(self, trailID, featureID):
+        with self.lock:
+            doc = self.docs.get(trailID)
+            if doc is None:
+                return
+            self._unindex(trailID)
+            doc["features"].pop(featureID, None)
+            self._index(trailID)
+
+    def _index(self, trailID):
+        doc = self.docs[trailID]
+        counts = {}
+        fields = [("name", doc["name"]), ("description", doc["description"])]
+        fields += [("feature", feature) for feature in doc["features"].values()]
+        for field, text in fields:
+            weight = self.FIELD_WEIGHTS[field]
+            for token in self.tokenise(text):
+                counts[token] = counts.get(token, 0.0) + weight
+
+        for term, tf in counts.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                bisect.insort(self.sorted_terms, term)
+                for trigram in self.term_trigrams(term):
+                    self.trigrams.setdefault(trigram, set()).add(term)
+            postings[trailID] = tf
+        length = sum(counts.values())
+        self.doc_terms[trailID] = counts
+        self.doc_lengths[trailID] = length
+        self.total_length += length
+
+    def _unindex(self, trailID):
+        counts = self.doc_terms.pop(trailID, None)
+        if counts is None:
+            return
+        for term in counts:
+            postings = self.postings[term]
+            postings.pop(trailID, None)
+            if not postings:
+                # last trail using this term, drop it from the lookup structures too
+                del self.postings[term]
+                del self.sorted_terms[bisect.bisect_left(self.sorted_terms, term)]
+                for trigram in self.term_trigrams(term):
+                    terms = self.trigrams[trigram]
+                    terms.discard(term)
+                    if not terms:
+                        del self.trigrams[trigram]
+        self.total_length -= self.doc_lengths.pop(trailID)
+
+    # expand a query token into (term, boost) pairs: exact, then prefix, then trigram fuzzy matches
+    def _expand(self, token, allow_prefix):
+        matches = {}
+        if token in self.postings:
+            matches[token] = 1.0
+        if allow_prefix:
+            start = bisect.bisect_left(self.sorted_terms, token)
+            for term in self.sorted_terms[start:start + 50]:
+                if not term.startswith(token):
+                    break
+                matches.setdefault(term, 0.8)
+        if not matches and len(token) >= 3:
+            grams = self.term_trigrams(token)
+            overlap = {}
+            for trigram in grams:
+                for term in self.trigrams.get(trigram, ()):
+                    overlap[term] = overlap.get(term, 0) + 1
+            for term, shared in overlap.items():
+                similarity = shared / (len(grams) + len(self.term_trigrams(term)) - shared)
+                if similarity >= 0.4:
+                    matches[term] = 0.5 * similarity
+        return matches
+
+    # viewer limits results to public trails and that user's own, None searches every trail
+    def search(self, query, limit=20, viewer=None):
+        tokens = self.tokenise(query)
+        if not tokens:
+            return []
+        with self.lock:
+            total_docs = len(self.doc_lengths)
+            if not total_docs:
+                return []
+            average_length = self.total_length / total_docs or 1.0
+            scores = {}
+            for position, token in enumerate(tokens):
+                # the word being typed is matched as a prefix, as is anything ending in *
+                allow_prefix = position == len(tokens) - 1 or query.rstrip().endswith('*')
+                for term, boost in self._expand(token, allow_prefix).items():
+                    postings = self.postings[term]
+                    idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for trailID, tf in postings.items():
+                        norm = tf + self.K1 * (1 - self.B + self.B * self.doc_lengths[trailID] / average_length)
+                        scores[trailID] = scores.get(trailID, 0.0) + boost * idf * tf * (self.K1 + 1) / norm
+            if viewer is not None:
+                scores = {trailID: score for trailID, score in scores.items()
+                          if self.docs[trailID]["isPublic"] or self.docs[trailID]["userID"] == viewer}
+            ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [{"trailID": trailID,
+                     "name": self.docs[trailID]["name"],
+                     "description": self.docs[trailID]["description"],
+                     "features": list(self.docs[trailID]["features"].values()),
+                     "score": round(score, 4)}
+                    for trailID, score in ranked]
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+# feature -> trail ID index for faceted filtering
+# each posting list is a sorted array of trail IDs so AND/OR queries are merges rather than SQL round trips
+# owners holds each user's trails the same way, so queries can be limited to what the caller may see
+class TrailFacetIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built = False
+        self.features = {} # normalised feature -> sorted array of trailIDs
+        self.labels = {} # normalised feature -> feature text as first seen
+        self.trail_features = {} # trailID -> {featureID: normalised feature}
+        self.flags = {"isPublic": array.array('l'), "loop": array.array('l')}
+        self.trails = array.array('l') # every known trailID
+        self.owners = {} # userID -> sorted array of trailIDs
+        self.trail_owners = {} # trailID -> userID
+
+    @staticmethod
+    def normalise(feature):
+        return " ".join(str(feature).casefold().split())
+
+    @staticmethod
+    def _add(ids, trailID):
+        position = bisect.bisect_left(ids, trailID)
+        if position == len(ids) or ids[position] != trailID:
+            ids.insert(position, trailID)
+
+    @staticmethod
+    def _remove(ids, trailID):
+        position = bisect.bisect_left(ids, trailID)
+        if position < len(ids) and ids[position] == trailID:
+            del ids[position]
+
+    @staticmethod
+    def intersect(small, large):
+        if len(small) > len(large):
+            small, large = large, small
+        result = array.array('l')
+        low = 0
+        for trailID in small:
+            low = bisect.bisect_left(large, trailID, low)
+            if low == len(large):
+                break
+            if large[low] == trailID:
+                result.append(trailID)
+        return result
+
+    @staticmethod
+    def union(*lists):
+        result = array.array('l')
+        for trailID in heapq.merge(*lists):
+            if not result or result[-1] != trailID:
+                result.append(trailID)
+        return result
+
+    # replace the whole index, trails are (TrailID, isPublic, loop, userID) and features (trailID, featureID, feature)
+    def load(self, trails, features):
+        with self.lock:
+            self.features, self.labels, self.trail_features = {}, {}, {}
+            self.flags = {"isPublic": array.array('l'), "loop": array.array('l')}
+            self.trails = array.array('l')
+            self.owners, self.trail_owners = {}, {}
+            for trailID, isPublic, loop, userID in sorted(trails):
+                self.set_trail(trailID, isPublic, loop, userID)
+            for trailID, featureID, feature in features:
+                self.set_feature(trailID, featureID, feature)
+            self.built = True
+
+    # userID None keeps the trail's current owner
+    def set_trail(self, trailID, isPublic, loop, userID=None):
+        with self.lock:
+            self._add(self.trails, trailID)
+            for flag, value in (("isPublic", isPublic), ("loop", loop)):
+                if value:
+                    self._add(self.flags[flag], trailID)
+                else:
+                    self._remove(self.flags[flag], trailID)
+            if userID is not None and self.trail_owners.get(trailID) != userID:
+                self._remove_owner(trailID)
+                self.trail_owners[trailID] = userID
+                self._add(self.owners.setdefault(userID, array.array('l')), trailID)
+
+    def remove_trail(self, trailID):
+        with self.lock:
+            self._remove(self.trails, trailID)
+            for ids in self.flags.values():
+                self._remove(ids, trailID)
+            self._remove_owner(trailID)
+            for featureID in list(self.trail_features.get(trailID, {})):
+                self.remove_feature(trailID, featureID)
+
+    def set_feature(self, trailID, featureID, feature):
+        with self.lock:
+            if trailID not in self.trail_features and not self._contains(self.trails, trailID):
+                return
+            self.remove_feature(trailID, featureID)
+            key = self.normalise(feature)
+            self.trail_features.setdefault(trailID, {})[featureID] = key
+            self.labels.setdefault(key, feature)
+            self._add(self.features.setdefault(key, array.array('l')), trailID)
+
+    def remove_feature(self, trailID, featureID):
+        with self.lock:
+            trail_features = self.trail_features.get(trailID, {})
+            key = trail_features.pop(featureID, None)
+            if not trail_features:
+                self.trail_features.pop(trailID, None)
+            # the same feature text can be listed twice on one trail, only drop it when the last goes
+            if key is None or key in trail_features.values():
+                return
+            ids = self.features[key]
+            self._remove(ids, trailID)
+            if not ids:
+                del self.features[key]
+                del self.labels[key]
+
+    def _remove_owner(self, trailID):
+        userID = self.trail_owners.pop(trailID, None)
+        if userID is None:
+            return
+        ids = self.owners[userID]
+        self._remove(ids, trailID)
+        if not ids:
+            del self.owners[userID]
+
+    def _contains(self, ids, trailID):
+        position = bisect.bisect_left(ids, trailID)
+        return position < len(ids) and ids[position] == trailID
+
+    # all_features are ANDed, any_features ORed, flags narrow the result further.
+    # viewer limits results and counts to public trails and that user's own, None covers every trail
+    def query(self, all_features=(), any_features=(), isPublic=None, loop=None, viewer=None):
+        with self.lock:
+            result = self.trails
+            if viewer is not None:
+                result = self.union(self.flags["isPublic"], self.owners.get(viewer, array.array('l')))
+            for feature in all_features:
+                result = self.intersect(result, self.features.get(self.normalise(feature), array.array('l')))
+            if any_features:
+                result = self.intersect(result, self.union(*[self.features.get(self.normalise(feature), array.array('l'))
+                                                              for feature in any_features]))
+            for flag, wanted in (("isPublic", isPublic), ("loop", loop)):
+                if wanted is True:
+                    result = self.intersect(result, self.flags[flag])
+                elif wanted is False:
+                    result = array.array('l', [trailID for trailID in result if not self._contains(self.flags[flag], trailID)])
+
+            counts = {self.labels[key]: len(self.intersect(result, ids)) for key, ids in self.features.items()}
+            flag_counts = {flag: len(self.intersect(result, ids)) for flag, ids in self.flags.items()}
+            return list(result), {label: count for label, count in counts.items() if count}, flag_counts
+
+
+# route planning graph built from the Location points of every trail
+# consecutive points on a trail are joined by an edge, and points from any trails that are within
+# the join radius of each other become the same node so routes can move between trails there.
+# adjacency is stored CSR style: the edges leaving node n are offsets[n]:offsets[n + 1] of the edge arrays.
+# nodes are kept in two grids of lat/lon cells: one at least the join radius across for joining points while
+# building, and a coarser one kept for nearest_node, so distances between cells bound the distances between nodes
+class RouteGraph:
+    SEARCH_CELL_SCALE = 16 # search grid cells are this many join cells across
+
+    def __init__(self, trail_points, join_radius):
+        self.join_radius = join_radius
+        self.node_lat = array.array('d')
+        self.node_lon = array.array('d')
+        self.location_nodes = {} # LocationID -> node
+        # a degree of longitude is shortest at the highest latitude, size the columns for that
+        highest = max((abs(latitude) for points in trail_points.values() for _, latitude, _ in points), default=0.0)
+        self.cell_lat = math.degrees(join_radius / EARTH_RADIUS)
+        self.cell_lon = min(360.0, self.cell_lat / max(math.cos(math.radians(highest)), 0.01))
+        grid = {}
+
+        edges = []
+        for trailID in sorted(trail_points):
+            previous = None
+            for locationID, latitude, longitude in trail_points[trailID]:
+                node = self._node_for(grid, latitude, longitude)
+                self.location_nodes[locationID] = node
+                if previous is not None and previous != node:
+                    edges.append((previous, node, haversine(self.node_lat[previous], self.node_lon[previous],
+                                                            latitude, longitude), trailID))
+                previous = node
+
+        # each edge is stored once in each direction
+        node_count = len(self.node_lat)
+        degree = [0] * (node_count + 1)
+        for u, v, _, _ in edges:
+            degree[u + 1] += 1
+            degree[v + 1] += 1
+        for n in range(node_count):
+            degree[n + 1] += degree[n]
+        self.offsets = array.array('l', degree)
+        fill = list(degree[:-1])
+        self.targets = array.array('l', [0] * (2 * len(edges)))
+        self.weights = array.array('d', [0.0] * (2 * len(edges)))
+        self.edge_trails = array.array('l', [0] * (2 * len(edges)))
+        for u, v, weight, trailID in edges:
+            for a, b in ((u, v), (v, u)):
+                self.targets[fill[a]] = b
+                self.weights[fill[a]] = weight
+                self.edge_trails[fill[a]] = trailID
+                fill[a] += 1
+
+        self.search_lat = self.cell_lat * self.SEARCH_CELL_SCALE
+        self.search_lon = min(360.0, self.cell_lon * self.SEARCH_CELL_SCALE)
+        # no point in the search grid's cells is further than this from the cell's centre
+        self.search_reach = EARTH_RADIUS * (math.radians(self.search_lat) + math.radians(self.search_lon)) / 2
+        self.search_grid = {} # (row, column) -> [node]
+        for node in range(len(self.node_lat)):
+            self.search_grid.setdefault(self._search_cell(self.node_lat[node], self.node_lon[node]), []).append(node)
+
+    # reuse a node already within the join radius, looking in the neighbouring grid cells only
+    def _node_for(self, grid, latitude, longitude):
+        row, column = int(latitude // self.cell_lat), int(longitude // self.cell_lon)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                for node in grid.get((row + dy, column + dx), ()):
+                    if haversine(self.node_lat[node], self.node_lon[node], latitude, longitude) <= self.join_radius:
+                        return node
+        node = len(self.node_lat)
+        self.node_lat.append(latitude)
+        self.node_lon.append(longitude)
+        grid.setdefault((row, column), []).append(node)
+        return node
+
+    def _search_cell(self, latitude, longitude):
+        return int(latitude // self.search_lat), int(longitude // self.search_lon)
+
+    # search the grid in square rings outward from the point's cell, stopping once nothing in the cells
+    # left could be closer than the best found. once a ring would cover more cells than are occupied
+    # (a point far from every trail), the rest are visited in order of distance to their centres instead
+    def nearest_node(self, latitude, longitude):
+        row, column = self._search_cell(latitude, longitude)
+        best, best_distance = None, math.inf
+        ring = 0
+        while (2 * ring + 1) ** 2 < len(self.search_grid):
+            best, best_distance = self._nearest_in(ring_cells(row, column, ring), latitude, longitude, best, best_distance)
+            if best_distance <= self._beyond_ring(latitude, ring):
+                return best
+            ring += 1
+
+        centres = sorted(
+            (haversine((cell[0] + 0.5) * self.search_lat, (cell[1] + 0.5) * self.search_lon, latitude, longitude), cell)
+            for cell in self.search_grid if max(abs(cell[0] - row), abs(cell[1] - column)) >= ring
+        )
+        for distance, cell in centres:
+            if distance - self.search_reach >= best_distance:
+                break
+            best, best_distance = self._nearest_in([cell], latitude, longitude, best, best_distance)
+        return best
+
+    def _nearest_in(self, cells, latitude, longitude, best, best_distance):
+        for cell in cells:
+            for node in self.search_grid.get(cell, ()):
+                distance = haversine(self.node_lat[node], self.node_lon[node], latitude, longitude)
+                if distance < best_distance:
+                    best, best_distance = node, distance
+        return best, best_distance
+
+    # lower bound on the distance from a point to anything outside the first `ring` rings around its cell.
+    # such a node is at least `ring` whole rows away, or `ring` whole columns away and within ring + 1 rows
+    def _beyond_ring(self, latitude, ring):
+        by_row = math.radians(ring * self.search_lat) * EARTH_RADIUS
+        nearest_pole = min(90.0, abs(latitude) + (ring + 1) * self.search_lat)
+        longitude_gap = math.radians(min(180.0, ring * self.search_lon))
+        by_column = 2 * EARTH_RADIUS * math.asin(math.cos(math.radians(nearest_pole)) * math.sin(longitude_gap / 2))
+        return min(by_row, by_column)
+
+    # A* from source to target, edges in `avoid` cost `penalty` times their length
+    def shortest_path(self, source, target, avoid=frozenset(), penalty=4.0):
+        target_lat, target_lon = self.node_lat[target], self.node_lon[target]
+        costs = {source: 0.0}
+        previous = {}
+        heap = [(0.0, 0.0, source)]
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node == target:
+                return self._path(previous, source, target)
+            if cost > costs[node]:
+                continue
+            for edge in range(self.offsets[node], self.offsets[node + 1]):
+                neighbour = self.targets[edge]
+                weight = self.weights[edge]
+                if (min(node, neighbour), max(node, neighbour)) in avoid:
+                    weight *= penalty
+                new_cost = cost + weight
+                if new_cost < costs.get(neighbour, math.inf):
+                    costs[neighbour] = new_cost
+                    previous[neighbour] = (node, edge)
+                    estimate = haversine(self.node_lat[neighbour], self.node_lon[neighbour], target_lat, target_lon)
+                    heapq.heappush(heap, (new_cost + estimate, new_cost, neighbour))
+        return None
+
+    # Dijkstra out to `limit` metres, returns distances and the tree to walk paths back from
+    def distances_from(self, source, limit):
+        distances = {source: 0.0}
+        previous = {}
+        heap = [(0.0, source)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            for edge in range(self.offsets[node], self.offsets[node + 1]):
+                neighbour = self.targets[edge]
+                new_distance = distance + self.weights[edge]
+                if new_distance <= limit and new_distance < distances.get(neighbour, math.inf):
+                    distances[neighbour] = new_distance
+                    previous[neighbour] = (node, edge)
+                    heapq.heappush(heap, (new_distance, neighbour))
+        return distances, previous
+
+    # loop of roughly `length` metres: go out to a turnaround point, come back avoiding the way out
+    def loop(self, source, length, candidates=30):
+        distances, previous = self.distances_from(source, length / 2)
+        turnarounds = sorted((node for node, distance in distances.items() if length * 0.25 <= distance <= length * 0.5),
+                             key=lambda node: distances[node])
+        if not turnarounds:
+            return None
+        step = max(1, len(turnarounds) // candidates)
+
+        best, best_score = None, None
+        for turnaround in turnarounds[::step]:
+            out_nodes, out_edges = self._path(previous, source, turnaround)
+            used = {(min(a, b), max(a, b)) for a, b in zip(out_nodes, out_nodes[1:])}
+            back = self.shortest_path(turnaround, source, avoid=used)
+            if back is None:
+                continue
+            back_nodes, back_edges = back
+            total = sum(self.weights[edge] for edge in out_edges + back_edges)
+            shared = sum(self.weights[edge] for a, b, edge in zip(back_nodes, back_nodes[1:], back_edges)
+                         if (min(a, b), max(a, b)) in used)
+            # closest to the asked length, preferring loops that don't retrace the way out
+            score = abs(total - length) / length + 0.5 * shared / total
+            if best_score is None or score < best_score:
+                best, best_score = (out_nodes + back_nodes[1:], out_edges + back_edges), score
+        return best
+
+    @staticmethod
+    def _path(previous, source, target):
+        nodes, edges = [target], []
+        while nodes[-1] != source:
+            node, edge = previous[nodes[-1]]
+            nodes.append(node)
+            edges.append(edge)
+        nodes.reverse()
+        edges.reverse()
+        return nodes, edges
+
+    def describe(self, nodes, edges):
+        trails = []
+        for edge in edges:
+            if not trails or trails[-1] != self.edge_trails[edge]:
+                trails.append(self.edge_trails[edge])
+        return {
+            "distanceKm": round(sum(self.weights[edge] for edge in edges) / 1000, 3),
+            "trails": trails,
+            "path": [{"latitude": self.node_lat[node], "longitude": self.node_lon[node]} for node in nodes],
+        }
+
+    def nbytes(self):
+        return sum(values.itemsize * len(values) for values in
+                   (self.node_lat, self.node_lon, self.offsets, self.targets, self.weights, self.edge_trails))
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+# the cells at Chebyshev distance `ring` from (row, column), the cell itself for ring 0
+def ring_cells(row, column, ring):
+    if ring == 0:
+        return [(row, column)]
+    cells = []
+    for offset in range(-ring, ring + 1):
+        cells += [(row - ring, column + offset), (row + ring, column + offset)]
+    for offset in range(-ring + 1, ring):
+        cells += [(row + offset, column - ring), (row + offset, column + ring)]
+    return cells
+
+
+EARTH_RADIUS = 6371000.0 # metres
+
+
+# compact location encodings, see location_response in app.py
+DELTA_HEADER = struct.Struct('<4sBII') # magic, version, trailID, point count
+DELTA_MAGIC = b'TRLD'
+
+
+def encode_polyline(latitudes, longitudes):
+    chars = []
+    previous_lat = previous_long = 0
+    for latitude, longitude in zip(latitudes, longitudes):
+        lat = int(round(latitude * 1e5))
+        long = int(round(longitude * 1e5))
+        for delta in (lat - previous_lat, long - previous_long):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chars.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chars.append(chr(value + 63))
+        previous_lat, previous_long = lat, long
+    return ''.join(chars)
+
+
+def write_varint(out, value):
+    value = (value << 1) if value >= 0 else ((-value) << 1) - 1 # zigzag so small negatives stay small
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_delta(columns):
+    out = bytearray(DELTA_HEADER.pack(DELTA_MAGIC, 1, columns['trailID'], len(columns['LocationID'])))
+    previous = [0, 0, 0, 0]
+    for point in zip(columns['LocationID'], columns['trailOrder'], columns['latitude'], columns['longitude']):
+        current = [point[0], point[1], int(round(point[2] * 1e6)), int(round(point[3] * 1e6))]
+        for i in range(4):
+            write_varint(out, current[i] - previous[i])
+        previous = current
+    return bytes(out)
@@ -0,0 +1,316 @@
+# journalled queue that batches location writes from live-tracking devices into the database
+# kept free of Flask and pyodbc so it can be tested on its own, app.py passes in the connection and change feed
+import atexit
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows, the write-behind journal isn't locked
+
+
+def location_payload(data):
+    return {"longitude": data['longitude'], "latitude": data['latitude'], "trailOrder": data['trailOrder']}
+
+
+# write-behind buffer for location writes
+# writes are journalled to a local file, coalesced in memory (last write wins per trailID/LocationID)
+# and flushed to the Location table in one transaction when the queue is big enough or the interval passes.
+# only one process may own the journal: it is locked, and a process that can't get the lock writes synchronously.
+# every journal entry has a sequence number and a "flushed" marker is fsynced right after each commit, so a
+# restart never replays a flushed batch. a crash in the moment between the commit and that marker can still
+# replay the batch: updates are idempotent but creates in that batch would be inserted again (at-least-once).
+# connect opens a DB-API connection, record_changes(cursor, changes) adds change feed rows in the same transaction,
+# row_errors are the exceptions that mean a row is bad rather than the connection,
+# on_flushed(trailIDs) is told which trails were written so cached copies can reload them
+class LocationWriteBuffer:
+    def __init__(self, journal_path, flush_size, flush_interval, connect, record_changes, row_errors, on_flushed=None):
+        self.journal_path = journal_path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.connect = connect
+        self.record_changes = record_changes
+        self.row_errors = row_errors
+        self.on_flushed = on_flushed
+        self.lock = threading.Lock() # guards the pending writes and the journal
+        self.flush_lock = threading.Lock() # only one flush at a time
+        self.wake = threading.Event()
+        self.updates = {} # (trailID, locationID) -> journal entry
+        self.creates = [] # journal entries, no ID yet so kept in order
+        self.seq = 0 # last sequence number written to the journal
+        self.journal = None
+        self.lock_file = None
+        self.thread = None
+        self.stopping = False
+        self.stats = {
+            "accepted": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "failedFlushes": 0,
+            "rowsFlushed": 0,
+            "deadLettered": 0,
+            "unmatchedUpdates": 0,
+            "lastFlushMs": 0.0,
+            "maxFlushMs": 0.0,
+            "totalFlushMs": 0.0,
+            "maxQueueDelayMs": 0.0,
+        }
+
+    # returns False when another process owns the journal, callers should then write synchronously
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return True
+            if not self._lock_journal():
+                return False
+            self._replay_journal()
+            self.journal = open(self.journal_path, 'a', encoding='utf-8')
+            self.thread = threading.Thread(target=self._run, name='location-write-behind', daemon=True)
+            self.thread.start()
+        atexit.register(self.stop)
+        return True
+
+    def _lock_journal(self):
+        if fcntl is None:
+            return True # no flock on Windows, rely on only the serving process starting the buffer
+        if self.lock_file is None:
+            self.lock_file = open(self.journal_path + '.lock', 'a')
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.flush_interval * 5)
+        self.flush()
+
+    def enqueue_update(self, trailID, locationID, longitude, latitude, trailOrder):
+        self._enqueue({"op": "update", "trailID": trailID, "locationID": locationID,
+                       "longitude": longitude, "latitude": latitude, "trailOrder": trailOrder})
+
+    def enqueue_create(self, trailID, longitude, latitude, trailOrder):
+        self._enqueue({"op": "create", "trailID": trailID,
+                       "longitude": longitude, "latitude": latitude, "trailOrder": trailOrder})
+
+    # drop pending writes for a location (or a whole trail) that is being deleted
+    def discard(self, trailID, locationID=None):
+        if self.thread is None:
+            return
+        with self.lock:
+            entry = {"op": "discard", "trailID": trailID, "locationID": locationID}
+            self._write_journal(entry)
+            self._apply(entry)
+
+    def _enqueue(self, entry):
+        with self.lock:
+            # journal first so an accepted write survives a crash before the flush
+            self._write_journal(entry)
+            self._apply(entry)
+            self.stats["accepted"] += 1
+            queued = len(self.updates) + len(self.creates)
+        if queued >= self.flush_size:
+            self.wake.set()
+
+    def _write_journal(self, entry):
+        # flushed to the OS on every write, fsynced once per batch in flush()
+        self.seq += 1
+        entry["seq"] = self.seq
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+
+    def _apply(self, entry):
+        entry.setdefault("queuedAt", time.time())
+        op = entry["op"]
+        if op == "update":
+            key = (entry["trailID"], entry["locationID"])
+            if key in self.updates:
+                self.stats["coalesced"] += 1
+            self.updates[key] = entry
+        elif op == "create":
+            self.creates.append(entry)
+        elif op == "discard":
+            trailID, locationID = entry["trailID"], entry["locationID"]
+            self.updates = {key: value for key, value in self.updates.items()
+                            if key[0] != trailID or (locationID is not None and key[1] != locationID)}
+            if locationID is None:
+                self.creates = [create for create in self.creates if create["trailID"] != trailID]
+
+    def _replay_journal(self):
+        # reload anything that was accepted but not flushed before the last shutdown
+        if not os.path.exists(self.journal_path):
+            return
+        entries = []
+        flushed = 0
+        with open(self.journal_path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # torn last line from a crash
+                if entry.get("op") == "flushed":
+                    flushed = max(flushed, entry["upTo"])
+                else:
+                    entries.append(entry)
+        for entry in entries:
+            if entry.get("seq", 0) > flushed:
+                try:
+                    self._apply(entry)
+                except KeyError:
+                    continue
+            self.seq = max(self.seq, entry.get("seq", 0))
+
+    def _rewrite_journal(self):
+        # compact the journal down to whatever is still pending, caller holds self.lock
+        self.journal.close()
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as journal:
+            for entry in sorted(list(self.updates.values()) + self.creates, key=lambda entry: entry["seq"]):
+                journal.write(json.dumps(entry) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Location flush failed: {e}")
+
+    # write a batch on an open cursor along with its ChangeLog rows, returns how many updates matched no row
+    def _write(self, cursor, updates, creates):
+        changes = []
+        unmatched = 0
+        for entry in updates:
+            cursor.execute("UPDATE Location SET longitude = ?, latitude = ?, trailOrder = ?"
+                           " WHERE trailID = ? AND LocationID = ?",
+                           (entry["longitude"], entry["latitude"], entry["trailOrder"],
+                            entry["trailID"], entry["locationID"]))
+            # the location may have been deleted while the update sat in the buffer
+            if not cursor.rowcount:
+                unmatched += 1
+                continue
+            changes.append(("Location", "upsert", entry["trailID"], entry["locationID"], location_payload(entry)))
+        # inserted one at a time so the change feed gets each new LocationID, still one transaction
+        for entry in creates:
+            cursor.execute("INSERT INTO Location (trailID, longitude, latitude, trailOrder)"
+                           " OUTPUT INSERTED.LocationID"
+                           " VALUES (?, ?, ?, ?)",
+                           (entry["trailID"], entry["longitude"], entry["latitude"], entry["trailOrder"]))
+            changes.append(("Location", "upsert", entry["trailID"], cursor.fetchone()[0], location_payload(entry)))
+        self.record_changes(cursor, changes)
+        return unmatched
+
+    # retry a failed batch a row at a time, rows the database rejects go straight to the dead letter file.
+    # rows leave `pending` once committed or dead-lettered so a connection failure part way re-queues only the rest
+    def _write_each(self, conn, pending):
+        dead = 0
+        unmatched = 0
+        while pending:
+            entry = pending[0]
+            cursor = conn.cursor()
+            try:
+                if entry["op"] == "update":
+                    unmatched += self._write(cursor, [entry], [])
+                else:
+                    self._write(cursor, [], [entry])
+                conn.commit()
+            except self.row_errors as e:
+                conn.rollback()
+                self._dead_letter([(entry, str(e))])
+                dead += 1
+                with self.lock:
+                    self.stats["deadLettered"] += 1
+            pending.pop(0)
+        return dead, unmatched
+
+    def _dead_letter(self, dead):
+        with open(self.journal_path + '.dead', 'a', encoding='utf-8') as dead_file:
+            for entry, error in dead:
+                dead_file.write(json.dumps({"entry": entry, "error": error, "at": time.time()}) + '\n')
+            dead_file.flush()
+            os.fsync(dead_file.fileno())
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.updates and not self.creates:
+                    return 0
+                pending = sorted(list(self.updates.values()) + self.creates, key=lambda entry: entry["seq"])
+                self.updates, self.creates = {}, []
+                up_to = self.seq
+                os.fsync(self.journal.fileno())
+
+            started = time.time()
+            batch = list(pending)
+            dead = 0
+            unmatched = 0
+            conn = None
+            try:
+                conn = self.connect()
+                try:
+                    unmatched = self._write(conn.cursor(),
+                                            [entry for entry in batch if entry["op"] == "update"],
+                                            [entry for entry in batch if entry["op"] == "create"])
+                    conn.commit()
+                    pending = []
+                except self.row_errors:
+                    # one bad row mustn't hold up every write behind it
+                    conn.rollback()
+                    dead, unmatched = self._write_each(conn, pending)
+            except Exception:
+                if conn is not None:
+                    conn.rollback()
+                with self.lock:
+                    # put back whatever didn't commit without overwriting anything newer that arrived meanwhile
+                    for entry in pending:
+                        if entry["op"] == "update":
+                            self.updates.setdefault((entry["trailID"], entry["locationID"]), entry)
+                    self.creates = [entry for entry in pending if entry["op"] == "create"] + self.creates
+                    self.stats["failedFlushes"] += 1
+                raise
+            finally:
+                if conn is not None:
+                    conn.close()
+                # cached copies reload these trails, some rows may have committed before a failure
+                if self.on_flushed is not None:
+                    self.on_flushed({entry["trailID"] for entry in batch})
+
+            with self.lock:
+                self.seq += 1
+                self.journal.write(json.dumps({"op": "flushed", "upTo": up_to, "seq": self.seq}) + '\n')
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self._rewrite_journal()
+
+            finished = time.time()
+            flush_ms = (finished - started) * 1000
+            oldest = min(entry["queuedAt"] for entry in batch)
+            with self.lock:
+                self.stats["flushes"] += 1
+                self.stats["rowsFlushed"] += len(batch) - dead
+                self.stats["unmatchedUpdates"] += unmatched
+                self.stats["lastFlushMs"] = round(flush_ms, 2)
+                self.stats["maxFlushMs"] = round(max(self.stats["maxFlushMs"], flush_ms), 2)
+                self.stats["totalFlushMs"] += flush_ms
+                self.stats["maxQueueDelayMs"] = round(max(self.stats["maxQueueDelayMs"], (finished - oldest) * 1000), 2)
+            return len(batch) - dead
+
+    def metrics(self):
+        with self.lock:
+            result = dict(self.stats)
+            result["queued"] = len(self.updates) + len(self.creates)
+        result["avgFlushMs"] = round(result["totalFlushMs"] / result["flushes"], 2) if result["flushes"] else 0.0
+        result["totalFlushMs"] = round(result["totalFlushMs"], 2)
+        result["journalOwner"] = self.thread is not None
+        return result